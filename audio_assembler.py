@@ -0,0 +1,121 @@
+import os
+import struct
+import subprocess
+from typing import List, Optional, Tuple, Union
+import numpy as np
+import soundfile as sf
+import tracing
+from moviepy.config import FFMPEG_BINARY
+import settings
+from settings import TTSGeneration
+
+
+WAV_DTYPES = {(1, 16): '<i2', (1, 32): '<i4', (3, 32): '<f4', (3, 64): '<f8'}
+BACKGROUND_CHUNK = 1 << 16 # Frames of background audio decoded at a time
+
+
+def map_wav(path: str) -> Tuple[Optional[np.ndarray], int]:
+    """
+    Memory-map the samples of a WAV file as a (frames, channels) array, returning it with the
+    sample rate. Returns None for the array if the encoding can't be mapped directly.
+    """
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            return None, 0
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None, 0
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(size - 16 + size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                offset = f.tell()
+                break
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
+    if fmt is None:
+        return None, 0
+    format_tag, channels, sample_rate, _, _, bits = fmt
+    dtype = WAV_DTYPES.get((format_tag, bits))
+    if dtype is None:
+        return None, sample_rate
+    frames = min(size, os.path.getsize(path) - offset) // (channels * bits // 8)
+    if frames == 0:
+        return np.zeros((0, channels), dtype=dtype), sample_rate
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(frames, channels)), sample_rate
+
+
+def read_samples(source: Union[str, Tuple[np.ndarray, int]], sample_rate: int) -> np.ndarray:
+    """
+    Return the samples of an audio file, or of a (samples, sample rate) pair from the packed audio
+    store, as mono float32 at the given sample rate.
+    """
+    if isinstance(source, str):
+        data, rate = map_wav(source)
+        if data is None:
+            data, rate = sf.read(source, dtype='float32', always_2d=True)
+    else:
+        data, rate = source
+    samples = data.mean(axis=1, dtype=np.float32) if data.shape[1] > 1 else data[:, 0].astype(np.float32)
+    if data.dtype.kind == 'i':
+        samples /= np.float32(2 ** (data.dtype.itemsize * 8 - 1))
+    if rate != sample_rate and len(samples):
+        # Linear resampling, only needed if the TTS sample rate changed after generating
+        times = np.arange(round(len(samples) * sample_rate / rate)) * (rate / sample_rate)
+        samples = np.interp(times, np.arange(len(samples)), samples).astype(np.float32)
+    return samples
+
+
+def mix_background(buffer: np.ndarray, path: str, sample_rate: int):
+    """Decode the background audio with ffmpeg and add it into the buffer a chunk at a time."""
+    channels = buffer.shape[1]
+    command = [FFMPEG_BINARY, '-loglevel', 'error', '-i', path,
+               '-f', 'f32le', '-ac', str(channels), '-ar', str(sample_rate), '-']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        position = 0
+        chunk_bytes = BACKGROUND_CHUNK * channels * 4
+        while position < len(buffer):
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            chunk = np.frombuffer(data, dtype=np.float32)
+            chunk = chunk[:len(chunk) // channels * channels].reshape(-1, channels)[:len(buffer) - position]
+            buffer[position:position + len(chunk)] += chunk
+            position += len(chunk)
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def assemble_audio(rows: List[Tuple[float, str, str]], audio_files: List[Union[str, Tuple[np.ndarray, int], None]], path: str):
+    """
+    Write the soundtrack of the video as a single WAV file.
+
+    Each line's audio is memory-mapped, from its WAV file or from the packed audio store, and
+    copied into one preallocated buffer at the line's offset in the timeline, leaving silence for
+    lines without audio. The background audio.mp3, if there is one, is decoded in chunks and
+    mixed in at full volume, in stereo.
+    """
+    with tracing.span('assemble audio', lines=len(rows)):
+        sample_rate = TTSGeneration.SAMPLE_RATE
+        background_path = os.path.join(settings.SOURCE_DIRECTORY, 'audio.mp3')
+        has_background = os.path.isfile(background_path)
+
+        starts = np.round(np.cumsum([0] + [row[0] for row in rows]) * sample_rate).astype(int)
+        buffer = np.zeros((starts[-1], 2 if has_background else 1), dtype=np.float32)
+        for index, audio_file in enumerate(audio_files):
+            if audio_file is None:
+                continue
+            samples = read_samples(audio_file, sample_rate)[:starts[index + 1] - starts[index]]
+            buffer[starts[index]:starts[index] + len(samples)] += samples[:, None]
+
+        if has_background:
+            mix_background(buffer, background_path, sample_rate)
+
+        sf.write(path, buffer, sample_rate, subtype='FLOAT')
@@ -0,0 +1,141 @@
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import soundfile as sf
+import settings
+from settings import TTSGeneration
+
+
+class PackedAudio:
+    """
+    The audio of every line packed into one file of raw 16-bit mono samples (audio/packed.pcm),
+    with an index (audio/packed.json) of each line's offset and length in samples.
+
+    New audio is appended to the end of the file, so lines that are reused or move to a new
+    index only change the index. The file is compacted once more than half of it is no longer
+    referenced. Samples are read as memory-mapped slices of the file without copying.
+
+    Appended lines are recorded in a log (audio/packed.log) of one index entry per line, which is
+    merged into the index when the store is closed, so each line costs the same to record however
+    many there are, and an interrupted run keeps every line logged before it stopped.
+    """
+
+    def __init__(self, directory: str = None):
+        directory = directory or os.path.join(settings.SOURCE_DIRECTORY, 'audio')
+        self.pcm_path = os.path.join(directory, 'packed.pcm')
+        self.index_path = os.path.join(directory, 'packed.json')
+        self.log_path = os.path.join(directory, 'packed.log')
+        self.sample_rate = TTSGeneration.SAMPLE_RATE
+        self.entries: Dict[str, List[int]] = {} # Line index -> [offset, length] in samples
+        self.end = 0 # Samples written to the file, anything after is left over from an interrupted append
+        self.samples = None
+        self.pcm_file = self.log_file = None
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            self.sample_rate, self.entries, self.end = index['sample_rate'], index['entries'], index['end']
+        if os.path.isfile(self.log_path):
+            self.read_log()
+
+    def read_log(self):
+        """Add the lines appended since the index was last saved, ignoring a record cut off by an interruption."""
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for record in f:
+                try:
+                    key, offset, length = json.loads(record)
+                except ValueError:
+                    break
+                self.entries[key] = [offset, length]
+                self.end = max(self.end, offset + length)
+
+    def __contains__(self, index: int) -> bool:
+        return str(index) in self.entries
+
+    def duration(self, index: int) -> float:
+        return self.entries[str(index)][1] / self.sample_rate
+
+    def get(self, index: int) -> Tuple[np.ndarray, int]:
+        """Return the samples of a line as a memory-mapped (samples, 1) array, with the sample rate."""
+        offset, length = self.entries[str(index)]
+        if length == 0:
+            return np.zeros((0, 1), dtype='<i2'), self.sample_rate
+        if self.samples is None:
+            self.samples = np.memmap(self.pcm_path, dtype='<i2', mode='r')
+        return self.samples[offset:offset + length, None], self.sample_rate
+
+    def append(self, index: int, audio: np.ndarray):
+        """Append the audio of a line to the file and record it in the log."""
+        samples = np.clip(np.round(np.asarray(audio, dtype=np.float32) * 32767), -32768, 32767).astype('<i2')
+        self.samples = None
+        if self.pcm_file is None:
+            self.save() # Start a new log, as the last one may end in a cut off record
+            self.pcm_file = open(self.pcm_path, 'r+b' if os.path.isfile(self.pcm_path) else 'w+b')
+            self.pcm_file.truncate(self.end * 2)
+            self.pcm_file.seek(self.end * 2)
+            self.log_file = open(self.log_path, 'a', encoding='utf-8')
+        self.pcm_file.write(samples.tobytes())
+        self.pcm_file.flush()
+
+        # Log the line only once its samples are written
+        self.entries[str(index)] = [self.end, len(samples)]
+        self.log_file.write(json.dumps([str(index), self.end, len(samples)]) + '\n')
+        self.log_file.flush()
+        self.end += len(samples)
+
+    def close(self):
+        """Merge the log into the index and close the files opened to append."""
+        if self.pcm_file is None:
+            return
+        self.pcm_file.close()
+        self.log_file.close()
+        self.pcm_file = self.log_file = None
+        self.save()
+
+    def remap(self, sources: List[Optional[int]]):
+        """Move reused lines to their new indices and drop the rest, as planned by a Manifest."""
+        self.entries = {str(index): self.entries[str(source)] for index, source in enumerate(sources)
+                        if source is not None and str(source) in self.entries}
+        if not self.entries:
+            self.sample_rate = TTSGeneration.SAMPLE_RATE
+        referenced = sum(length for _, length in {tuple(entry) for entry in self.entries.values()})
+        if referenced * 2 < self.end:
+            self.compact()
+        self.save()
+
+    def compact(self):
+        """Rewrite the file with only the referenced samples."""
+        temp_path = self.pcm_path + '.tmp'
+        moved = {}
+        end = 0
+        with open(temp_path, 'wb') as f:
+            for key, (offset, length) in sorted(self.entries.items(), key=lambda item: item[1][0]):
+                if (offset, length) not in moved:
+                    f.write(self.get(int(key))[0].tobytes())
+                    moved[(offset, length)] = end
+                    end += length
+                self.entries[key] = [moved[(offset, length)], length]
+        self.samples = None
+        os.replace(temp_path, self.pcm_path)
+        self.end = end
+
+    def save(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'sample_rate': self.sample_rate, 'end': self.end, 'entries': self.entries}, f)
+        os.replace(temp_path, self.index_path)
+        if os.path.isfile(self.log_path):
+            os.remove(self.log_path)
+
+
+def export_wavs():
+    """Write the audio of every line in the packed store out as individual WAV files, audio/{index}.wav."""
+    store = PackedAudio()
+    audio_dir = os.path.dirname(store.index_path)
+    for key in sorted(store.entries, key=int):
+        samples, sample_rate = store.get(int(key))
+        sf.write(os.path.join(audio_dir, f'{key}.wav'), samples, sample_rate, subtype='PCM_16')
+
+
+if __name__ == "__main__":
+    export_wavs()
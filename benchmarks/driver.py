@@ -0,0 +1,71 @@
+"""
+Run the generate_video.py pipeline on story directories with settings overridden from a JSON config,
+recording the wall time, CPU time and peak memory of each step. Started by run.py in a fresh process.
+With several story directories they're run as one batch, and each step's times are summed over them.
+
+Usage: python driver.py <config.json> <story directory>...
+"""
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_usage():
+    """Return the CPU seconds used by this process and its children, and the peak RSS of either in MB."""
+    if resource is None:
+        return time.process_time(), None
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024 # ru_maxrss is in bytes on macOS and KB elsewhere
+    peak = max(own.ru_maxrss, children.ru_maxrss) / scale
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime, peak
+
+
+def main():
+    config_path, story_directories = sys.argv[1], sys.argv[2:]
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    # Import the pipeline as generate_video.py would be run on the story directory
+    os.chdir(REPOSITORY)
+    sys.path.insert(0, REPOSITORY)
+    sys.argv = ['generate_video.py'] + story_directories
+    import settings
+    for name, value in config['settings'].items():
+        section, attribute = name.split('.')
+        setattr(getattr(settings, section), attribute, value)
+    import generate_video
+
+    results = {}
+    run_step = generate_video.run_step
+
+    def timed_step(name, *args, **kwargs):
+        if name in config['skip']:
+            print(f"Skipping {name} (benchmark)")
+            return False
+        start, (cpu_start, _) = time.perf_counter(), get_usage()
+        worked = run_step(name, *args, **kwargs)
+        wall, (cpu, peak) = time.perf_counter() - start, get_usage()
+        result = results.setdefault(name, {'step': name, 'wall': 0, 'cpu': 0, 'peak_rss': peak})
+        result['wall'] += wall
+        result['cpu'] += cpu - cpu_start
+        result['peak_rss'] = peak
+        return worked
+
+    generate_video.run_step = timed_step
+    generate_video.main()
+
+    with open(config['results'], 'w', encoding='utf-8') as f:
+        json.dump(list(results.values()), f)
+
+
+if __name__ == "__main__":
+    main()
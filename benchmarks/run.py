@@ -0,0 +1,186 @@
+"""
+End-to-end benchmark of the pipeline against local stand-in servers, runnable without GPUs or models.
+
+A synthetic story is generated, stub LLM and ComfyUI servers and a stub Kokoro package stand in for
+the real models, and generate_video.py's pipeline is run on it in a fresh process. The wall time, CPU
+time, throughput and peak memory of each step are reported, and can be saved and compared against
+an earlier run to catch regressions.
+
+Example: python benchmarks/run.py --captions 1000 --image-latency 0.1 --skip "video rendering"
+"""
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from stub_servers import ComfyServer, LLMServer, serve
+from synthetic_story import write_story
+
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+STEPS = ['caption splitting', 'TTS generation', 'script annotation', 'scene generation', 'image generation',
+         'streaming generation', 'video rendering']
+
+
+def run_servers(options, ports):
+    """Start the stub servers and report their ports, then serve until terminated."""
+    llm = LLMServer(first_token_latency=options.llm_latency, token_latency=options.token_latency,
+                    tokens=options.tokens, think_tokens=options.think_tokens, parallel=options.llm_parallel)
+    comfy = [ComfyServer(image_latency=options.image_latency) for _ in range(options.image_servers)]
+    serve([llm] + comfy)
+    ports.put((llm.server_address[1], [server.server_address[1] for server in comfy]))
+    multiprocessing.Event().wait()
+
+
+def count_items(directories):
+    """Return the number of items each step produced in the story directories."""
+    counts = {}
+    for directory in directories:
+        for step, count in count_story_items(directory).items():
+            counts[step] = counts.get(step, 0) + count
+    return counts
+
+
+def count_story_items(directory):
+    """Return the number of items each step produced in a story directory."""
+    def count_blocks(name):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            return 0
+        with open(path, 'r', encoding='utf-8') as f:
+            return len([block for block in f.read().split('\n\n') if block.strip()])
+    images_directory = os.path.join(directory, 'images')
+    images = len([name for name in os.listdir(images_directory) if name.endswith('.png')]) if os.path.isdir(images_directory) else 0
+    captions = count_blocks('captions.txt')
+    return {'caption splitting': captions, 'TTS generation': captions, 'script annotation': captions,
+            'scene generation': count_blocks('scenes.txt'), 'image generation': images,
+            'streaming generation': images, 'video rendering': captions}
+
+
+def print_results(runs, items):
+    print(f"\n{'step':<20}{'wall s':>10}{'cpu s':>10}{'items':>8}{'items/s':>10}{'peak RSS MB':>13}")
+    for index, results in enumerate(runs):
+        print(f"run {index + 1} ({'cold' if index == 0 else 'warm'})")
+        for result in results:
+            count = items.get(result['step'], 0)
+            rate = count / result['wall'] if result['wall'] else 0
+            peak = f"{result['peak_rss']:.0f}" if result['peak_rss'] is not None else '-'
+            print(f"  {result['step']:<18}{result['wall']:>10.2f}{result['cpu']:>10.2f}{count:>8}{rate:>10.1f}{peak:>13}")
+        print(f"  {'total':<18}{sum(result['wall'] for result in results):>10.2f}")
+
+
+def compare(runs, baseline_path, tolerance, noise=0.05):
+    """Print the steps of the cold run that are slower than in the baseline by more than tolerance, returning True if any are."""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {result['step']: result for result in json.load(f)['runs'][0]}
+    regressed = False
+    print(f"\nCompared with {baseline_path}:")
+    for result in runs[0]:
+        base = baseline.get(result['step'])
+        if base is None:
+            continue
+        change = (result['wall'] - base['wall']) / base['wall'] if base['wall'] else 0
+        slower = change > tolerance and result['wall'] - base['wall'] > noise
+        regressed |= slower
+        print(f"  {result['step']:<18}{base['wall']:>8.2f}s -> {result['wall']:>8.2f}s ({change:+.0%}){'  REGRESSION' if slower else ''}")
+    return regressed
+
+
+def parse_setting(text):
+    name, _, value = text.partition('=')
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--captions', type=int, default=100, help="Number of captions in the synthetic story")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic story")
+    parser.add_argument('--stories', type=int, default=1, help="Number of synthetic stories, more than one are run as one batch")
+    parser.add_argument('--directory', help="Story directory to use, a temporary one by default")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary story directory")
+    parser.add_argument('--repeat', type=int, default=1, help="Number of runs, the ones after the first rerunning on the same outputs")
+    parser.add_argument('--skip', nargs='*', default=[], choices=STEPS, help="Steps to skip")
+    parser.add_argument('--set', nargs='*', default=[], metavar='SECTION.NAME=VALUE', help="Settings to override, e.g. VideoGeneration.ENGINE=numpy")
+    parser.add_argument('--backend', choices=['ollama', 'openai'], default='ollama', help="LLM API to serve")
+    parser.add_argument('--llm-latency', type=float, default=0.05, help="Seconds before the first token of each LLM response")
+    parser.add_argument('--token-latency', type=float, default=0.002, help="Seconds per generated token")
+    parser.add_argument('--tokens', type=int, default=60, help="Tokens per LLM response")
+    parser.add_argument('--think-tokens', type=int, default=0, help="Reasoning tokens before each LLM response")
+    parser.add_argument('--llm-parallel', type=int, default=4, help="LLM requests generated at once")
+    parser.add_argument('--image-latency', type=float, default=0.2, help="Seconds per image on each ComfyUI server")
+    parser.add_argument('--image-servers', type=int, default=1, help="Number of ComfyUI servers")
+    parser.add_argument('--tts-latency', type=float, default=0.01, help="Seconds of TTS work per caption")
+    parser.add_argument('--tts-mode', choices=['cpu', 'sleep'], default='cpu', help="Whether TTS work keeps the CPU busy or sleeps")
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Compare against results saved with --save, exiting with 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Fraction a step may slow down by before it's a regression")
+    parser.add_argument('--quiet', action='store_true', help="Hide the pipeline's own output")
+    options = parser.parse_args()
+
+    directory = os.path.abspath(options.directory or tempfile.mkdtemp(prefix='story-benchmark-'))
+    story_directories = [directory] if options.stories <= 1 else [os.path.join(directory, f'story{index}') for index in range(options.stories)]
+    for index, story_directory in enumerate(story_directories):
+        os.makedirs(story_directory, exist_ok=True)
+        story_path = os.path.join(story_directory, 'story.txt')
+        if not os.path.isfile(story_path):
+            write_story(story_path, options.captions, options.seed + index)
+
+    ports = multiprocessing.Queue()
+    servers = multiprocessing.Process(target=run_servers, args=(options, ports), daemon=True)
+    servers.start()
+    try:
+        llm_port, comfy_ports = ports.get(timeout=30)
+
+        cache_directory = os.path.join(story_directories[0], '.cache')
+        settings = {
+            'PromptGeneration.HOST': '127.0.0.1',
+            'PromptGeneration.PORT': llm_port,
+            'PromptGeneration.USE_OLLAMA': options.backend == 'ollama',
+            'PromptGeneration.CACHE_PATH': os.path.join(cache_directory, 'responses.sqlite'),
+            'ImageGeneration.SERVERS': [f'127.0.0.1:{port}' for port in comfy_ports],
+            'VideoGeneration.SUBTITLE_CACHE': os.path.join(cache_directory, 'subtitles'),
+            'Pipeline.DYNAMICALLY_UNLOAD_OLLAMA': False, # There's no ollama binary to stop the stub model with
+        }
+        settings.update(parse_setting(setting) for setting in options.set)
+
+        runs = []
+        for index in range(options.repeat):
+            with tempfile.TemporaryDirectory() as temp_directory:
+                config_path = os.path.join(temp_directory, 'config.json')
+                results_path = os.path.join(temp_directory, 'results.json')
+                with open(config_path, 'w', encoding='utf-8') as f:
+                    json.dump({'settings': settings, 'skip': options.skip, 'results': results_path}, f)
+
+                environment = dict(os.environ, BENCH_TTS_LATENCY=str(options.tts_latency), BENCH_TTS_MODE=options.tts_mode)
+                environment['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.join(BENCHMARKS, 'stubs'), os.environ.get('PYTHONPATH')]))
+                output = subprocess.DEVNULL if options.quiet else None
+                subprocess.run([sys.executable, os.path.join(BENCHMARKS, 'driver.py'), config_path] + story_directories,
+                               env=environment, stdout=output, check=True)
+                with open(results_path, 'r', encoding='utf-8') as f:
+                    runs.append(json.load(f))
+    finally:
+        servers.terminate()
+
+    items = count_items(story_directories)
+    print_results(runs, items)
+    if options.save:
+        with open(options.save, 'w', encoding='utf-8') as f:
+            json.dump({'options': vars(options), 'items': items, 'runs': runs}, f, indent=2)
+    regressed = compare(runs, options.compare, options.tolerance) if options.compare else False
+
+    if not options.directory and not options.keep:
+        shutil.rmtree(directory)
+    else:
+        print(f"\nOutputs kept in {directory}")
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
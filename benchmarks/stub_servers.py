@@ -0,0 +1,360 @@
+"""
+Local stand-ins for the model servers the pipeline talks to, with configurable latency.
+
+LLMServer answers Ollama /api/generate and OpenAI /v1/chat/completions requests, streamed or not.
+ComfyServer accepts prompts on /prompt, runs them one at a time like a single GPU, reports progress
+over /ws and serves the results from /history and /view, or as binary frames for SaveImageWebsocket.
+"""
+import base64
+import hashlib
+import io
+import itertools
+import json
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from PIL import Image
+
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+LATENT_IMAGE_CLASSES = ["EmptySD3LatentImage", "EmptyLatentImage", "EmptyFlux2LatentImage"]
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep connections alive, like the real servers
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_body(self, body: bytes, content_type='application/json', status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode('utf-8'), status=status)
+
+    def start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def send_chunk(self, data: bytes):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+
+# Share of the reasoning produced at each OpenAI reasoning_effort
+REASONING = {'none': 0.0, 'minimal': 0.0, 'low': 0.25, 'medium': 0.5}
+
+
+class LLMServer(ThreadingHTTPServer):
+    """
+    Stub LLM server. Each response takes first_token_latency plus token_latency per token, with at
+    most parallel requests generated at once. Responses are think_tokens words of reasoning in
+    <think> tags followed by tokens words of text, chosen deterministically from the prompt. With a
+    JSON schema, the text is a JSON object holding tokens words for each of the schema's properties.
+    Requests with Ollama's think set to false get no reasoning, and requests with an OpenAI
+    reasoning_effort get a share of it (none at "none" or "minimal", a quarter at "low", half at
+    "medium"), as a real reasoning model may keep reasoning at a low effort.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, first_token_latency=0.05, token_latency=0.002, tokens=60, think_tokens=0, parallel=4):
+        super().__init__(('127.0.0.1', port), LLMHandler)
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.tokens = tokens
+        self.think_tokens = think_tokens
+        self.slots = threading.Semaphore(parallel)
+        self.requests = 0
+
+    def generate(self, prompt: str, schema: dict = None, reasoning: float = 1.0):
+        """Yield the response to a prompt a token at a time, taking the configured time."""
+        rng = random.Random(hashlib.sha256(prompt.encode('utf-8')).digest())
+        words = ['lantern', 'forest', 'castle', 'storm', 'harbor', 'village', 'mountain', 'shadow',
+                 'silver', 'garden', 'window', 'ancient', 'glowing', 'quiet', 'misty', 'golden']
+        tokens = []
+        think_tokens = int(self.think_tokens * reasoning)
+        if think_tokens:
+            tokens = ['<think>'] + [f' {rng.choice(words)}' for _ in range(think_tokens)] + ['</think>']
+        if schema is None:
+            tokens += [('' if i == 0 else ' ') + rng.choice(words) for i in range(self.tokens)] + ['.']
+        else:
+            for index, name in enumerate(schema.get('properties', {})):
+                tokens.append(('{' if index == 0 else ', ') + json.dumps(name) + ': "')
+                tokens += [('' if i == 0 else ' ') + rng.choice(words) for i in range(self.tokens)] + ['."']
+            tokens.append('}' if schema.get('properties') else '{}')
+        with self.slots:
+            self.requests += 1
+            time.sleep(self.first_token_latency)
+            for token in tokens:
+                if self.token_latency:
+                    time.sleep(self.token_latency)
+                yield token
+
+
+class LLMHandler(JSONHandler):
+
+    def do_POST(self):
+        request = self.read_json()
+        try:
+            if self.path == '/api/generate':
+                self.ollama(request)
+            elif self.path == '/v1/chat/completions':
+                self.openai(request)
+            else:
+                self.send_json({'error': 'not found'}, 404)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True # Streaming clients disconnect to stop a response early
+
+    def ollama(self, request):
+        schema = request.get('format') if isinstance(request.get('format'), dict) else None
+        tokens = self.server.generate(request.get('prompt', ''), schema, 1.0 if request.get('think', True) is not False else 0.0)
+        if not request.get('stream', True):
+            self.send_json({'model': request.get('model'), 'response': ''.join(tokens), 'done': True})
+            return
+        self.start_chunked('application/x-ndjson')
+        count = 0
+        for token in tokens:
+            count += 1
+            self.send_chunk(json.dumps({'response': token, 'done': False}).encode() + b'\n')
+        self.send_chunk(json.dumps({'response': '', 'done': True, 'eval_count': count}).encode() + b'\n')
+        self.send_chunk(b'')
+
+    def openai(self, request):
+        prompt = '\n'.join(message.get('content', '') for message in request.get('messages', []))
+        schema = request.get('response_format', {}).get('json_schema', {}).get('schema')
+        tokens = self.server.generate(prompt, schema, REASONING.get(request.get('reasoning_effort'), 1.0))
+        if not request.get('stream'):
+            message = {'role': 'assistant', 'content': ''.join(tokens)}
+            self.send_json({'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}]})
+            return
+        self.start_chunked('text/event-stream')
+        for token in tokens:
+            chunk = {'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]}
+            self.send_chunk(f'data: {json.dumps(chunk)}\n\n'.encode())
+        self.send_chunk(b'data: [DONE]\n\n')
+        self.send_chunk(b'')
+
+
+class WebSocket:
+    """Server side of a WebSocket connection, sending unmasked frames as RFC 6455 requires."""
+
+    def __init__(self, handler: BaseHTTPRequestHandler):
+        self.rfile = handler.rfile
+        self.wfile = handler.wfile
+        self.lock = threading.Lock()
+        self.open = True
+
+    def send(self, payload, binary=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        opcode = 0x2 if binary else 0x1
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.lock:
+            if not self.open:
+                return
+            try:
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+            except OSError:
+                self.open = False
+
+    def receive(self):
+        """Read frames until the client closes the connection, answering pings."""
+        while self.open:
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                break
+            opcode, length = header[0] & 0x0F, header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self.rfile.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self.rfile.read(8))[0]
+            mask = self.rfile.read(4) if header[1] & 0x80 else b'\0\0\0\0'
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.rfile.read(length)))
+            if opcode == 0x8:
+                with self.lock:
+                    self.wfile.write(b'\x88\x00')
+                break
+            if opcode == 0x9:
+                with self.lock:
+                    self.wfile.write(struct.pack('!BB', 0x8A, len(payload)) + payload)
+        self.open = False
+
+
+class ComfyServer(ThreadingHTTPServer):
+    """
+    Stub ComfyUI server. Prompts run one at a time, each taking image_latency seconds, and produce
+    a flat PNG of the size set in the workflow in a color chosen from the prompt. Like ComfyUI, a
+    save node whose inputs are the same as in an earlier prompt isn't run again: a SaveImage node
+    reports its earlier output, and a SaveImageWebsocket node sends nothing.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, image_latency=0.2):
+        super().__init__(('127.0.0.1', port), ComfyHandler)
+        self.image_latency = image_latency
+        self.pending = queue.Queue()
+        self.queued = []
+        self.running = None
+        self.history = {}
+        self.cached = {} # Inputs of each save node already run -> its output
+        self.files = {}
+        self.sockets = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.completed = 0
+        threading.Thread(target=self.run_prompts, daemon=True).start()
+
+    def send_event(self, client_id, kind, data):
+        websocket = self.sockets.get(client_id)
+        if websocket:
+            websocket.send(json.dumps({'type': kind, 'data': data}))
+
+    def run_prompts(self):
+        while True:
+            prompt_id, workflow, client_id = self.pending.get()
+            with self.lock:
+                self.queued.remove(prompt_id)
+                self.running = prompt_id
+            self.send_event(client_id, 'execution_start', {'prompt_id': prompt_id})
+            signatures = {node_id: json.dumps([workflow, node_id], sort_keys=True) for node_id in workflow}
+            if any(signature not in self.cached for signature in signatures.values()):
+                time.sleep(self.image_latency)
+
+            image = render_image(workflow)
+            outputs = {}
+            for node_id, node in workflow.items():
+                class_type = node.get('class_type')
+                if class_type not in ['SaveImage', 'SaveImageWebsocket']:
+                    continue
+                if signatures[node_id] in self.cached:
+                    if self.cached[signatures[node_id]] is not None:
+                        outputs[node_id] = self.cached[signatures[node_id]]
+                    continue
+                self.send_event(client_id, 'executing', {'node': node_id, 'prompt_id': prompt_id})
+                if class_type == 'SaveImageWebsocket':
+                    websocket = self.sockets.get(client_id)
+                    if websocket:
+                        websocket.send(struct.pack('>II', 1, 2) + image, binary=True)
+                    self.cached[signatures[node_id]] = None
+                    continue
+                filename = f'{prompt_id}_{node_id}.png'
+                self.files[filename] = image
+                outputs[node_id] = {'images': [{'filename': filename, 'subfolder': '', 'type': 'output'}]}
+                self.cached[signatures[node_id]] = outputs[node_id]
+                self.send_event(client_id, 'executed', {'node': node_id, 'output': outputs[node_id], 'prompt_id': prompt_id})
+
+            with self.lock:
+                self.history[prompt_id] = {'outputs': outputs, 'status': {'status_str': 'success', 'completed': True}}
+                self.running = None
+                self.completed += 1
+            self.send_event(client_id, 'executing', {'node': None, 'prompt_id': prompt_id})
+
+
+def render_image(workflow) -> bytes:
+    """Return a PNG of the size set in the workflow, in a color derived from its prompt text."""
+    width = height = 512
+    prompt = ''
+    for node in workflow.values():
+        class_type, inputs = node.get('class_type'), node.get('inputs', {})
+        title = node.get('_meta', {}).get('title')
+        if class_type in LATENT_IMAGE_CLASSES:
+            width, height = inputs.get('width', width), inputs.get('height', height)
+        elif class_type == 'PrimitiveInt' and title in ['Width', 'Height']:
+            width, height = (inputs['value'], height) if title == 'Width' else (width, inputs['value'])
+        elif class_type == 'CLIPTextEncode' and isinstance(inputs.get('text'), str):
+            prompt += inputs['text']
+        elif class_type == 'PrimitiveStringMultiline':
+            prompt += str(inputs.get('value', ''))
+    color = tuple(hashlib.sha256(prompt.encode('utf-8')).digest()[:3])
+    buffer = io.BytesIO()
+    Image.new('RGB', (int(width), int(height)), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class ComfyHandler(JSONHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/ws':
+            self.websocket(parse_qs(url.query).get('clientId', [''])[0])
+        elif url.path == '/queue':
+            with self.server.lock:
+                running = [[0, self.server.running]] if self.server.running else []
+                pending = [[0, prompt_id] for prompt_id in self.server.queued]
+            self.send_json({'queue_running': running, 'queue_pending': pending})
+        elif url.path.startswith('/history/'):
+            prompt_id = url.path[len('/history/'):]
+            with self.server.lock:
+                entry = self.server.history.get(prompt_id)
+            self.send_json({prompt_id: entry} if entry else {})
+        elif url.path == '/view':
+            image = self.server.files.get(parse_qs(url.query).get('filename', [''])[0])
+            if image is None:
+                self.send_json({'error': 'not found'}, 404)
+            else:
+                self.send_body(image, 'image/png')
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        request = self.read_json()
+        if self.path == '/prompt':
+            prompt_id = str(uuid.uuid4())
+            with self.server.lock:
+                self.server.queued.append(prompt_id)
+            self.server.pending.put((prompt_id, request['prompt'], request.get('client_id')))
+            self.send_json({'prompt_id': prompt_id, 'number': next(self.server.counter), 'node_errors': {}})
+        elif self.path == '/free':
+            self.send_json({})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def websocket(self, client_id):
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        websocket = WebSocket(self)
+        self.server.sockets[client_id] = websocket
+        websocket.send(json.dumps({'type': 'status', 'data': {'sid': client_id}}))
+        try:
+            websocket.receive()
+        finally:
+            if self.server.sockets.get(client_id) is websocket:
+                del self.server.sockets[client_id]
+            self.close_connection = True
+
+
+def serve(servers):
+    """Start each server on a daemon thread."""
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
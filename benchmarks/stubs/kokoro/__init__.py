@@ -0,0 +1,33 @@
+"""
+Stand-in for the Kokoro TTS package used by the benchmarks.
+
+KPipeline produces a quiet tone as long as the text would take to read at 150 words per minute.
+Each line costs BENCH_TTS_LATENCY seconds (default 0.01), spent busy on the CPU like real synthesis,
+or asleep if BENCH_TTS_MODE is 'sleep'.
+"""
+import os
+import time
+import numpy as np
+
+
+SAMPLE_RATE = 24000
+WORDS_PER_MINUTE = 150
+
+
+class KPipeline:
+    def __init__(self, lang_code='a', **kwargs):
+        self.latency = float(os.environ.get('BENCH_TTS_LATENCY', 0.01))
+        self.sleep = os.environ.get('BENCH_TTS_MODE') == 'sleep'
+
+    def __call__(self, text, voice=None, speed=1, **kwargs):
+        texts = [text] if isinstance(text, str) else text
+        for text in texts:
+            deadline = time.perf_counter() + self.latency
+            if self.sleep:
+                time.sleep(self.latency)
+            else:
+                while time.perf_counter() < deadline:
+                    pass
+            duration = max(len(text.split()), 1) / WORDS_PER_MINUTE * 60 / speed
+            samples = np.arange(int(duration * SAMPLE_RATE), dtype=np.float32)
+            yield text, '', 0.1 * np.sin(samples * (2 * np.pi * 220 / SAMPLE_RATE))
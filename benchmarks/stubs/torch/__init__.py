@@ -0,0 +1,5 @@
+"""Stand-in for the parts of torch the TTS stage touches when running against the stub Kokoro package."""
+
+
+def set_num_threads(threads):
+    pass
@@ -0,0 +1,41 @@
+import random
+
+
+WORDS = """the a of and to in was he she it that his her with for as on at by from they you had but not
+what all were when we there can an your which their said if will each about how up out them then many
+some so these would other into has more two like him see time could no make than first been its who
+now people my made over did down only way find use may water long little very after words called just
+where most know get through back much before go good new write our used me man too any day same right
+look think also around another came come work three word must because does part even place well such
+here take why things help put years different away again off went old number great tell men say small
+every found still between name should home big give air line set own under read last never us left end
+along while might next sound below saw something thought both few those always looked show large often
+together asked house world going want school important until form food keep children feet land side
+without boy once animals life enough took sometimes four head above kind began almost live page got
+earth need far hand high year mother light parts country father let night following picture being study
+second eyes soon times story boys since white days ever paper hard near sentence better best across during
+today others however sure means knew try told young miles sun ways thing whole hear example heard several
+change answer room sea against top turned learn point city play toward five using himself usually river
+lantern forest castle storm harbor village mountain whisper shadow silver garden window letter journey""".split()
+
+
+def make_sentence(rng: random.Random) -> str:
+    """Return a sentence of 80 to 140 characters, so no two fit in one caption and each is a caption of its own."""
+    words = []
+    while len(' '.join(words)) < 80:
+        words.append(rng.choice(WORDS))
+    while len(' '.join(words)) > 138:
+        words.pop()
+    sentence = ' '.join(words)
+    return sentence[0].upper() + sentence[1:] + rng.choice(['.', '.', '.', '!', '?'])
+
+
+def write_story(path: str, captions: int, seed: int = 0):
+    """Write a story of random paragraphs that splits into the given number of captions."""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        written = 0
+        while written < captions:
+            sentences = min(rng.randint(3, 6), captions - written)
+            f.write(' '.join(make_sentence(rng) for _ in range(sentences)) + '\n\n')
+            written += sentences
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+import settings
+
+
+def digest(*parts) -> str:
+    """Return a stable hex digest of the given values."""
+    h = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """Return the hex digest of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Per-stage record of the input key that produced each output item.
+
+    Items are identified by their index in the stage's output. When the stage reruns,
+    each item's key is recomputed from its inputs and compared against the manifest, so
+    only items whose inputs changed are regenerated. Lookups are content-addressed, so
+    an unchanged item that moved to a new index (e.g. after a caption was inserted
+    before it) is reused rather than regenerated.
+
+    A manifest that does not exist yet adopts whatever outputs are already on disk, so
+    upgrading from a run without a manifest doesn't throw away existing work.
+
+    Items can also be recorded one at a time in a log next to the manifest, which is merged
+    into it on the next save, so a long stage records each item as it's written without
+    rewriting the whole manifest every time.
+    """
+
+    def __init__(self, stage: str):
+        self.path = os.path.join(settings.SOURCE_DIRECTORY, '.cache', f'{stage}.json')
+        self.log_path = os.path.join(settings.SOURCE_DIRECTORY, '.cache', f'{stage}.log')
+        self.log_file = None
+        self.adopt = not os.path.isfile(self.path)
+        self.entries: Dict[str, str] = {}
+        if not self.adopt:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+            if os.path.isfile(self.log_path):
+                self.read_log()
+
+    def read_log(self):
+        """Add the items recorded since the last save, ignoring a record cut off by an interruption."""
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for record in f:
+                try:
+                    index, key = json.loads(record)
+                except ValueError:
+                    break
+                self.entries[str(index)] = key
+
+    def plan(self, keys: List[str], exists: Callable[[int], bool]) -> List[Optional[int]]:
+        """
+        Match each new key against the existing outputs.
+
+        Returns a list with, for each item, the index of an existing output produced from
+        the same key, or None if the item has to be regenerated.
+        """
+        by_key: Dict[str, int] = {}
+        for index, key in self.entries.items():
+            if exists(int(index)):
+                by_key.setdefault(key, int(index))
+
+        sources: List[Optional[int]] = []
+        for index, key in enumerate(keys):
+            if self.adopt and exists(index):
+                sources.append(index)
+            else:
+                sources.append(by_key.get(key))
+        return sources
+
+    def reset(self, keys: List[str], sources: List[Optional[int]]):
+        """Record the keys of every reused item, dropping everything else."""
+        self.entries = {str(i): key for i, (key, source) in enumerate(zip(keys, sources)) if source is not None}
+        self.adopt = False
+        self.save()
+
+    def set(self, index: int, key: str):
+        self.entries[str(index)] = key
+
+    def record(self, index: int, key: str):
+        """Set an item's key and append it to the log, keeping it if the stage is interrupted before the next save."""
+        if self.log_file is None:
+            self.save() # Start a new log, as the last one may end in a cut off record
+            self.log_file = open(self.log_path, 'a', encoding='utf-8')
+        self.set(index, key)
+        self.log_file.write(json.dumps([index, key]) + '\n')
+        self.log_file.flush()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.path)
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        if os.path.isfile(self.log_path):
+            os.remove(self.log_path)
+
+
+def remap_files(directory: str, extension: str, sources: List[Optional[int]]):
+    """
+    Move reused output files to their new indices and delete stale ones.
+
+    Files are first moved aside to temporary names so that shifting items never
+    overwrites an output that is still needed.
+    """
+    if not os.path.isdir(directory):
+        return
+    path = lambda name: os.path.join(directory, f'{name}.{extension}')
+    keep = {index for index, source in enumerate(sources) if source == index}
+    uses: Dict[int, int] = {}
+    for index, source in enumerate(sources):
+        if source is not None and source != index:
+            uses[source] = uses.get(source, 0) + 1
+
+    # Stage every file that changes index under a temporary name first
+    staged = []
+    for index, source in enumerate(sources):
+        if source is None or source == index:
+            continue
+        temp_path = path(f'{index}.remap')
+        uses[source] -= 1
+        if uses[source] or source in keep:
+            shutil.copyfile(path(source), temp_path)
+        else:
+            os.replace(path(source), temp_path)
+        staged.append((temp_path, path(index)))
+
+    # Delete outputs that are no longer reused at their current index
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        if ext == f'.{extension}' and stem.isdigit() and int(stem) not in keep:
+            os.remove(os.path.join(directory, name))
+
+    for temp_path, final_path in staged:
+        os.replace(temp_path, final_path)
+
+
+class ResponseCache:
+    """
+    Persistent cache of LLM responses stored in a SQLite database, keyed by a digest of the request.
+
+    The least recently used responses are evicted once the stored responses exceed max_bytes.
+    Lookups can be disabled with enabled=False to sample fresh responses, in which case new
+    responses still replace the cached ones.
+    """
+
+    def __init__(self, path: str, max_bytes: int, enabled: bool = True):
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses '
+            '(key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.connection.commit()
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = None
+            if self.enabled:
+                row = self.connection.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            row = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.size += size - (row[0] if row else 0)
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, response, size, time.time()))
+
+            # Evict the least recently used responses until the cache fits
+            while self.size > self.max_bytes:
+                oldest = self.connection.execute('SELECT key, size FROM responses ORDER BY accessed LIMIT 64').fetchall()
+                if not oldest: break
+                for old_key, old_size in oldest:
+                    self.connection.execute('DELETE FROM responses WHERE key = ?', (old_key,))
+                    self.size -= old_size
+                    if self.size <= self.max_bytes: break
+            self.connection.commit()
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses"
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = self.misses = 0
@@ -1,51 +1,62 @@
 import nltk
 import os
-from settings import CaptionSplitter, SOURCE_DIRECTORY
-from typing import List
+from nltk.tokenize.punkt import PunktTokenizer
+import settings
+from settings import CaptionSplitter
+from typing import Iterable, Iterator
 
 
-def split_lines(text: str, max_characters: int) -> List[str]:
+_tokenizer = None
 
-    paragraphs = text.split("\n")
-    paragraphs = [line.strip() for line in paragraphs if line.strip()]
 
-    captions: List[str] = []
-    nltk.download('punkt_tab')
+def get_tokenizer() -> PunktTokenizer:
+    """Load the sentence tokenizer once, downloading it only if it isn't in the local nltk data yet."""
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            nltk.data.find('tokenizers/punkt_tab/english/')
+        except LookupError:
+            nltk.download('punkt_tab')
+        _tokenizer = PunktTokenizer('english')
+    return _tokenizer
+
+
+def split_lines(paragraphs: Iterable[str], max_characters: int) -> Iterator[str]:
+    """Yield the captions of each paragraph in turn, so only one paragraph is held in memory at a time."""
+
+    tokenizer = get_tokenizer()
     sentence_seperator = ' '
 
     for paragraph in paragraphs:
+        paragraph = paragraph.strip()
+        if not paragraph: continue
 
-        sentences = nltk.sent_tokenize(paragraph)
-        lines: List[str] = []
+        sentences = tokenizer.tokenize(paragraph)
 
         current_line = ""
         for sentence in sentences:
             if len(current_line) + len(sentence) + len(sentence_seperator) > max_characters:
-                if current_line.strip(): lines.append(current_line.strip())
+                if current_line.strip(): yield current_line.strip()
                 current_line = sentence
             else:
                 current_line += f'{sentence_seperator}{sentence}'
 
-        lines.append(current_line.strip())
-        captions.extend(lines)
-
-    return captions
+        yield current_line.strip()
 
 
 def split_captions(filename: str = 'captions'):
 
-    # Parse and split the provided story file
-    story_path = os.path.join(SOURCE_DIRECTORY, 'story.txt')
-    with open(story_path, 'r', encoding='utf-8') as f:
-        text = f.read()
-    lines = split_lines(text, CaptionSplitter.MAX_CHARACTERS)
-
-    # Write the sentences to a new file, each on a new line
-    file_path = os.path.join(SOURCE_DIRECTORY, f'{filename}.txt')
-    with open(file_path, 'w', encoding='utf-8') as f:
-        for line in lines:
+    # Stream the story file through the splitter, writing each caption as it's produced
+    story_path = os.path.join(settings.SOURCE_DIRECTORY, 'story.txt')
+    file_path = os.path.join(settings.SOURCE_DIRECTORY, f'{filename}.txt')
+    temp_path = file_path + '.tmp'
+    with open(story_path, 'r', encoding='utf-8') as story, open(temp_path, 'w', encoding='utf-8') as f:
+        for line in split_lines(story, CaptionSplitter.MAX_CHARACTERS):
             f.write(line + '\n\n')
 
+    # Replace the previous captions only once the whole story is split
+    os.replace(temp_path, file_path)
+
 
 if __name__ == "__main__":
-    split_captions("captions")
\ No newline at end of file
+    split_captions("captions")
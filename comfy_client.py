@@ -0,0 +1,405 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import urllib.error
+import urllib.parse
+import urllib.request
+import websocket
+import tracing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class ComfyError(RuntimeError):
+    """Raised when ComfyUI fails to execute a prompt or the connection to it is lost."""
+
+
+class ComfyConnectionError(ComfyError):
+    """Raised when a ComfyUI server can't be reached or the connection to it is lost."""
+
+
+PREVIEW_IMAGE = 1 # Binary WebSocket event type used for images sent by SaveImageWebsocket nodes
+
+
+def save_atomic(path: str, write):
+    """Write a file by passing a temporary file to write, then renaming it into place so it's never left truncated."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.part'
+    try:
+        with open(temp_path, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class _Job:
+    def __init__(self, save_path: str):
+        self.save_path = save_path
+        self.images = []
+        self.image_data = None
+        self.future = Future()
+        self.queued = (time.time(), time.perf_counter())
+
+
+class ComfyClient:
+    """
+    Pipelined client for a single ComfyUI server.
+
+    Up to queue_depth prompts are kept queued on the server so the GPU never waits on this
+    client. A background thread reads the single WebSocket connection and routes the
+    'executing'/'executed' events to the prompt they belong to, and finished images are
+    downloaded and saved on a pool of worker threads while the next prompt runs.
+
+    Images are transferred according to transfer:
+        'history': downloaded from /view in one read.
+        'stream': streamed from /view straight to disk in chunks.
+        'websocket': received as binary frames on the WebSocket from the websocket_outputs nodes
+                     (SaveImageWebsocket nodes), skipping the /view round trip entirely. ComfyUI
+                     doesn't run nodes whose inputs are cached, which would send no image for a
+                     repeated prompt, so each prompt gives these nodes a unique extra input that
+                     makes them run again (only them, the rest of the workflow is still cached).
+    Images are always written through a temporary file, so a crash never leaves one truncated.
+    """
+
+    def __init__(self, host: str, port: int, queue_depth: int = 2, download_workers: int = 2,
+                 transfer: str = 'history', websocket_outputs=()):
+        self.base_url = f"http://{host}:{port}"
+        self.client_id = str(uuid.uuid4())
+        self.transfer = transfer
+        self.websocket_outputs = set(websocket_outputs)
+        self.executing = (None, None)
+        self.slots = threading.BoundedSemaphore(max(queue_depth, 1))
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.downloads = ThreadPoolExecutor(max_workers=max(download_workers, 1))
+        self.ws = websocket.WebSocket()
+        self.ws.connect(f"ws://{host}:{port}/ws?clientId={self.client_id}")
+        self.receiver = threading.Thread(target=self._receive, daemon=True)
+        self.receiver.start()
+
+    def queue_prompt(self, workflow):
+        """Queue a prompt with ComfyUI and return the prompt_id."""
+        url = f"{self.base_url}/prompt"
+        data = json.dumps({"prompt": workflow, "client_id": self.client_id}).encode('utf-8')
+        req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+        with tracing.span('comfy queue_prompt', server=self.base_url), urllib.request.urlopen(req) as response:
+            return json.loads(response.read())["prompt_id"]
+
+    def get_history(self, prompt_id):
+        """Fetch the execution history for a completed prompt."""
+        url = f"{self.base_url}/history/{prompt_id}"
+        with urllib.request.urlopen(url) as response:
+            return json.loads(response.read())[prompt_id]
+
+    def download_image(self, filename, subfolder="", image_type="output", file=None):
+        """Download a generated image from ComfyUI's /view endpoint, streaming it into file in chunks if provided."""
+        params = urllib.parse.urlencode({"filename": filename, "subfolder": subfolder, "type": image_type})
+        url = f"{self.base_url}/view?{params}"
+        with tracing.span('comfy download_image', server=self.base_url), urllib.request.urlopen(url) as response:
+            if file is None:
+                return response.read()
+            shutil.copyfileobj(response, file, 1 << 20)
+
+    def submit(self, workflow, save_path: str) -> Future:
+        """
+        Queue a configured workflow, blocking while queue_depth prompts are already queued.
+        Returns a future that resolves to save_path once the first output image is saved there.
+        """
+        if self.transfer == 'websocket':
+            workflow = {node_id: {**node, 'inputs': {**node.get('inputs', {}), 'cache_buster': uuid.uuid4().hex}}
+                        if node_id in self.websocket_outputs else node for node_id, node in workflow.items()}
+        self.slots.acquire()
+        job = _Job(save_path)
+        try:
+            # Hold the lock while queueing so events for this prompt wait until it is registered
+            with self.lock:
+                if self.closed:
+                    raise ComfyConnectionError("Connection to ComfyUI is closed")
+                self.jobs[self.queue_prompt(workflow)] = job
+        except Exception:
+            self.slots.release()
+            raise
+        return job.future
+
+    def close(self):
+        """Close the connection, failing any prompts that haven't finished yet."""
+        self._fail_all(ComfyConnectionError("Connection to ComfyUI was closed"))
+        self.ws.close()
+        self.downloads.shutdown(wait=True)
+
+    def _receive(self):
+        try:
+            while True:
+                message = self.ws.recv()
+                if isinstance(message, str):
+                    self._handle(json.loads(message))
+                else:
+                    self._handle_binary(message)
+        except Exception as e:
+            self._fail_all(ComfyConnectionError(f"Lost connection to ComfyUI: {e}"))
+
+    def _handle(self, message):
+        kind = message.get("type")
+        data = message.get("data", {})
+        if kind == "executing":
+            self.executing = (data.get("prompt_id"), data.get("node"))
+        with self.lock:
+            job = self.jobs.get(data.get("prompt_id"))
+        if job is None:
+            return
+
+        if kind == "executed":
+            job.images.extend(data.get("output", {}).get("images", []))
+        elif kind == "executing" and data.get("node") is None:
+            if self._finish(data["prompt_id"]):
+                self.downloads.submit(self._save, data["prompt_id"], job)
+        elif kind in ("execution_error", "execution_interrupted"):
+            if self._finish(data["prompt_id"]):
+                job.future.set_exception(ComfyError(data.get("exception_message", "Prompt failed to execute")))
+
+    def _handle_binary(self, message):
+        # Binary frames don't name their prompt, but the server runs one node at a time,
+        # so they belong to the node of the last 'executing' event
+        prompt_id, node = self.executing
+        if node not in self.websocket_outputs or len(message) <= 8:
+            return
+        if int.from_bytes(message[:4], 'big') != PREVIEW_IMAGE:
+            return
+        with self.lock:
+            job = self.jobs.get(prompt_id)
+        if job is not None and job.image_data is None:
+            job.image_data = message[8:] # Skip the event type and image format
+
+    def _finish(self, prompt_id) -> bool:
+        """Stop tracking a prompt and free its queue slot, returning False if it already finished."""
+        with self.lock:
+            job = self.jobs.pop(prompt_id, None)
+            if job is None:
+                return False
+        self.slots.release()
+        queued_time, queued_counter = job.queued
+        tracing.record('comfy wait_for_completion', queued_time, time.perf_counter() - queued_counter, server=self.base_url)
+        return True
+
+    def _save(self, prompt_id, job):
+        with tracing.span('comfy save', server=self.base_url):
+            self._save_image(prompt_id, job)
+
+    def _save_image(self, prompt_id, job):
+        try:
+            if self.transfer == 'websocket' and job.image_data is not None:
+                save_atomic(job.save_path, lambda f: f.write(job.image_data))
+                job.future.set_result(job.save_path)
+                return
+
+            # Without an image over the WebSocket, fall back to any image the prompt saved on the server
+            images = job.images
+            if not images:
+                outputs = self.get_history(prompt_id).get("outputs", {})
+                images = [image for output in outputs.values() for image in output.get("images", [])]
+            if not images:
+                raise ComfyError(f"Prompt {prompt_id} produced no images")
+
+            # Save only the first image
+            image = images[0]
+            args = (image["filename"], image.get("subfolder", ""), image.get("type", "output"))
+            if self.transfer == 'stream':
+                save_atomic(job.save_path, lambda f: self.download_image(*args, file=f))
+            else:
+                image_data = self.download_image(*args)
+                save_atomic(job.save_path, lambda f: f.write(image_data))
+            job.future.set_result(job.save_path)
+        except Exception as e:
+            job.future.set_exception(e)
+
+    def _fail_all(self, error):
+        with self.lock:
+            self.closed = True
+            jobs = list(self.jobs.values())
+            self.jobs.clear()
+        for job in jobs:
+            self.slots.release()
+            if not job.future.done():
+                job.future.set_exception(error)
+
+
+def get_queue_length(host: str, port: int, timeout: float = 5) -> int:
+    """Return the number of prompts running or pending on a ComfyUI server, raising if it can't be reached."""
+    with urllib.request.urlopen(f"http://{host}:{port}/queue", timeout=timeout) as response:
+        data = json.loads(response.read())
+    return len(data.get("queue_running", [])) + len(data.get("queue_pending", []))
+
+
+class _Endpoint:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.client = None
+        self.outstanding = 0
+        self.external = 0
+        self.completed = 0
+        self.failures = 0
+        self.busy = 0.0
+
+    @property
+    def name(self):
+        return f"{self.host}:{self.port}"
+
+
+class ComfyPool:
+    """
+    Spreads prompts across several ComfyUI servers, each driven by its own ComfyClient.
+
+    Each prompt goes to the healthy server with the least outstanding work, counting both the
+    prompts this pool has queued there and any queued by other clients (probed through /queue).
+    A server whose connection drops is marked down and its prompts are retried on another
+    server, and down servers are probed periodically so they can rejoin the pool.
+    """
+
+    def __init__(self, endpoints, queue_depth: int = 2, download_workers: int = 2,
+                 retries: int = 2, health_interval: float = 30, **client_options):
+        self.queue_depth = max(queue_depth, 1)
+        self.download_workers = download_workers
+        self.client_options = client_options
+        self.retries = retries
+        self.health_interval = health_interval
+        self.endpoints = [_Endpoint(host, port) for host, port in endpoints]
+        self.condition = threading.Condition()
+        self.started = time.monotonic()
+        self.closed = False
+        for endpoint in self.endpoints:
+            self._connect(endpoint)
+        if not any(endpoint.client for endpoint in self.endpoints):
+            raise ComfyConnectionError(f"No ComfyUI server is reachable: {', '.join(e.name for e in self.endpoints)}")
+        self.health = threading.Thread(target=self._check_health, daemon=True)
+        self.health.start()
+
+    def submit(self, workflow, save_path: str) -> Future:
+        """Queue a workflow on the least busy server, blocking while every server's queue is full."""
+        future = Future()
+        self._dispatch(workflow, save_path, future, 0, set())
+        return future
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for endpoint in self.endpoints:
+            if endpoint.client:
+                endpoint.client.close()
+
+    def print_stats(self):
+        elapsed = time.monotonic() - self.started
+        for endpoint in self.endpoints:
+            rate = endpoint.completed / elapsed * 60 if elapsed else 0
+            average = endpoint.busy / endpoint.completed if endpoint.completed else 0
+            print(f"  {endpoint.name}: {endpoint.completed} images ({rate:.1f}/min, {average:.1f}s each), "
+                  f"{endpoint.failures} failures{'' if endpoint.client else ', down'}")
+
+    def _connect(self, endpoint):
+        try:
+            endpoint.external = get_queue_length(endpoint.host, endpoint.port)
+            endpoint.client = ComfyClient(endpoint.host, endpoint.port, self.queue_depth,
+                                          self.download_workers, **self.client_options)
+        except Exception as e:
+            print(f"ComfyUI server {endpoint.name} is unavailable: {e}")
+            endpoint.client = None
+
+    def _mark_down(self, endpoint, error):
+        with self.condition:
+            client, endpoint.client = endpoint.client, None
+            self.condition.notify_all()
+        if client:
+            # Close from a new thread, since this may run on one of the client's own threads
+            print(f"\nComfyUI server {endpoint.name} dropped, retrying its prompts elsewhere: {error}")
+            threading.Thread(target=client.close, daemon=True).start()
+
+    def _acquire(self, exclude):
+        """Reserve a queue slot on the least busy healthy server, preferring ones not in exclude."""
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise ComfyConnectionError("ComfyUI pool is closed")
+                healthy = [e for e in self.endpoints if e.client]
+                if not healthy:
+                    raise ComfyConnectionError("No ComfyUI server is available")
+                candidates = [e for e in healthy if e not in exclude] or healthy
+                candidates = [e for e in candidates if e.outstanding < self.queue_depth]
+                if candidates:
+                    endpoint = min(candidates, key=lambda e: e.outstanding + e.external)
+                    endpoint.outstanding += 1
+                    return endpoint
+                self.condition.wait()
+
+    def _release(self, endpoint):
+        with self.condition:
+            endpoint.outstanding -= 1
+            self.condition.notify_all()
+
+    def _dispatch(self, workflow, save_path, future, attempt, exclude):
+        while True:
+            endpoint = self._acquire(exclude)
+            client = endpoint.client
+            try:
+                if client is None:
+                    raise ComfyConnectionError("Server went down")
+                inner = client.submit(workflow, save_path)
+                break
+            except urllib.error.HTTPError:
+                self._release(endpoint)
+                raise
+            except Exception as e:
+                self._release(endpoint)
+                self._mark_down(endpoint, e)
+        started = time.monotonic()
+        inner.add_done_callback(lambda inner: self._done(
+            endpoint, inner, started, workflow, save_path, future, attempt, exclude))
+
+    def _done(self, endpoint, inner, started, workflow, save_path, future, attempt, exclude):
+        self._release(endpoint)
+        error = inner.exception()
+        if error is None:
+            endpoint.completed += 1
+            endpoint.busy += time.monotonic() - started
+            future.set_result(inner.result())
+            return
+
+        endpoint.failures += 1
+        if isinstance(error, ComfyConnectionError):
+            self._mark_down(endpoint, error)
+        if attempt >= self.retries or self.closed:
+            future.set_exception(error)
+            return
+
+        # Retry on another server from a new thread, since dispatching may block on a free slot
+        def retry():
+            try:
+                self._dispatch(workflow, save_path, future, attempt + 1, exclude | {endpoint})
+            except Exception as e:
+                future.set_exception(e)
+        threading.Thread(target=retry, daemon=True).start()
+
+    def _check_health(self):
+        while not self.closed:
+            time.sleep(self.health_interval)
+            for endpoint in self.endpoints:
+                if self.closed:
+                    return
+                if endpoint.client is None:
+                    self._connect(endpoint)
+                    if endpoint.client:
+                        print(f"\nComfyUI server {endpoint.name} is back online")
+                        with self.condition:
+                            self.condition.notify_all()
+                    continue
+                try:
+                    queued = get_queue_length(endpoint.host, endpoint.port)
+                    endpoint.external = max(queued - endpoint.outstanding, 0)
+                except Exception as e:
+                    self._mark_down(endpoint, e)
@@ -0,0 +1,173 @@
+import os
+import subprocess
+import tempfile
+import textwrap
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple
+import tracing
+from moviepy.config import FFMPEG_BINARY
+from PIL import ImageColor, ImageFont
+from frame_compositor import (FrameCompositor, ImageSpan, get_audio_arguments, get_chunks, get_image_path,
+                              get_visible, write_concat_list)
+from settings import VideoGeneration
+from subtitle_cache import get_subtitle_height
+from utility import print_progress_bar
+
+
+def ass_color(color: str) -> str:
+    red, green, blue = ImageColor.getrgb(color)[:3]
+    return f'&H00{blue:02X}{green:02X}{red:02X}'
+
+
+def ass_time(seconds: float) -> str:
+    centiseconds = round(seconds * 100)
+    return f'{centiseconds // 360000}:{centiseconds // 6000 % 60:02d}:{centiseconds // 100 % 60:02d}.{centiseconds % 100:02d}'
+
+
+def ass_text(text: str) -> str:
+    """Wrap and escape a line of text so libass renders it literally."""
+    # A word joiner after each backslash stops libass reading it as an override like \N
+    text = text.replace('\\', '\\\u2060').replace('{', '\\{').replace('}', '\\}')
+    return '\\N'.join(textwrap.wrap(text, VideoGeneration.CHARACTERS_PER_LINE))
+
+
+def write_subtitles(rows: List[Tuple[float, str, str]], path: str, start: float = 0, end: float = None):
+    """
+    Write the captions shown between start and end seconds as an ASS subtitle file, centered in the
+    subtitle band, with times relative to start.
+    """
+    # libass sizes fonts by line height rather than em size, so size them to match the line height of TextClip
+    try:
+        font = ImageFont.truetype(VideoGeneration.FONT, VideoGeneration.FONT_SIZE)
+        font_name, font_size = font.getname()[0], sum(font.getmetrics())
+    except OSError:
+        font_name, font_size = VideoGeneration.FONT, VideoGeneration.FONT_SIZE
+    band_height = get_subtitle_height()
+    position = f'\\an5\\pos({VideoGeneration.WIDTH // 2},{VideoGeneration.HEIGHT - band_height // 2})'
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[Script Info]\nScriptType: v4.00+\nWrapStyle: 2\nScaledBorderAndShadow: yes\n')
+        f.write(f'PlayResX: {VideoGeneration.WIDTH}\nPlayResY: {VideoGeneration.HEIGHT}\n\n')
+        f.write('[V4+ Styles]\n')
+        f.write('Format: Name, Fontname, Fontsize, PrimaryColour, OutlineColour, BackColour, BorderStyle, Outline, Shadow, Alignment\n')
+        f.write(f'Style: Default,{font_name},{font_size},{ass_color(VideoGeneration.TEXT_COLOR)},'
+                f'&H00000000,&H00000000,1,0,0,5\n\n')
+        f.write('[Events]\nFormat: Layer, Start, End, Style, Text\n')
+        row_start = 0
+        for duration, _, text in rows:
+            row_end = row_start + duration
+            if row_end > start and (end is None or row_start < end):
+                f.write(f'Dialogue: 0,{ass_time(max(row_start - start, 0))},{ass_time(row_end - start)},'
+                        f'Default,{{{position}}}{ass_text(text)}\n')
+            row_start = row_end
+
+
+def get_filtergraph(spans: List[ImageSpan], subtitles_path: str, start: int, end: int) -> str:
+    """
+    Build the filtergraph that renders frames start to end of the video from the image inputs of the
+    given consecutive spans, matching the moviepy layout: each image is scaled to the video height
+    and overlaid on a black canvas, panning upwards over its duration plus the crossfade, consecutive
+    images are joined with xfade, and the subtitle band and burned-in captions are drawn on top.
+    """
+    width, height, frame_rate = VideoGeneration.WIDTH, VideoGeneration.HEIGHT, VideoGeneration.FRAME_RATE
+    crossfade = VideoGeneration.CROSSFADE_DURATION
+    pan_distance = height * VideoGeneration.SUBTITLE_RATIO
+
+    filters = []
+    for index, span in enumerate(spans):
+        length = span.duration + crossfade
+        filters.append(f'color=c=black:s={width}x{height}:r={frame_rate}:d={length:.6f}[canvas{index}]')
+        filters.append(f'[{index}:v]scale=-1:{height},setsar=1[image{index}]')
+        filters.append(f'[canvas{index}][image{index}]overlay=x=(main_w-overlay_w)/2:'
+                       f'y=-t/{length:.6f}*{pan_distance:.6f}:eval=frame:shortest=1,format=yuv420p[clip{index}]')
+
+    # Join the clips, each starting to fade in where the previous image's duration ends
+    if crossfade > 0:
+        last = 'clip0'
+        for index, span in enumerate(spans[1:], start=1):
+            offset = span.start - spans[0].start
+            filters.append(f'[{last}][clip{index}]xfade=transition=fade:duration={crossfade}:offset={offset:.6f}[joined{index}]')
+            last = f'joined{index}'
+    else:
+        filters.append(''.join(f'[clip{index}]' for index in range(len(spans))) + f'concat=n={len(spans)}:v=1:a=0[joined]')
+        last = 'joined'
+
+    # Cut out the frames, counted from the start of the first image, padding the end in case of rounding
+    first = round(start - spans[0].start * frame_rate)
+    filters.append(f'[{last}]tpad=stop_mode=clone:stop_duration=1,'
+                   f'trim=start_frame={first}:end_frame={first + end - start},setpts=PTS-STARTPTS[cut]')
+
+    # Draw the subtitle band and burn in the captions
+    band_height = get_subtitle_height()
+    red, green, blue = ImageColor.getrgb(VideoGeneration.BACKGROUND_COLOR)[:3]
+    fonts_dir = os.path.dirname(os.path.abspath(VideoGeneration.FONT)) if os.path.isfile(VideoGeneration.FONT) else None
+    filters.append(f'[cut]drawbox=x=0:y={height - band_height}:w={width}:h={band_height}:'
+                   f'color=0x{red:02X}{green:02X}{blue:02X}@1:t=fill,'
+                   f"ass=filename='{subtitles_path}'" + (f":fontsdir='{fonts_dir}'" if fonts_dir else '') + '[v]')
+    return ';\n'.join(filters)
+
+
+def render_segment(rows: List[Tuple[float, str, str]], start: int, end: int, output_path: str):
+    """
+    Render frames start to end in one ffmpeg process from a generated filtergraph, as a video
+    without audio, or as numbered images when generating frames. Only the images drawn in these
+    frames are opened as inputs.
+    """
+    compositor = FrameCompositor(rows)
+    visible = get_visible(compositor.span_starts, start, end)
+    spans = compositor.spans[max(visible.start - 1, 0):visible.stop]
+    frame_rate = VideoGeneration.FRAME_RATE
+    with tempfile.TemporaryDirectory() as temp_dir:
+        subtitles_path = os.path.join(temp_dir, 'subtitles.ass')
+        write_subtitles(rows, subtitles_path, start / frame_rate, end / frame_rate)
+        filtergraph_path = os.path.join(temp_dir, 'filtergraph.txt')
+        with open(filtergraph_path, 'w', encoding='utf-8') as f:
+            f.write(get_filtergraph(spans, subtitles_path, start, end))
+
+        command = [FFMPEG_BINARY, '-y', '-loglevel', 'error']
+        for span in spans:
+            length = span.duration + VideoGeneration.CROSSFADE_DURATION
+            command += ['-loop', '1', '-framerate', str(frame_rate),
+                        '-t', f'{length:.6f}', '-i', get_image_path(span.name)]
+        command += ['-filter_complex_script', filtergraph_path, '-map', '[v]', '-frames:v', str(end - start)]
+        if VideoGeneration.GENERATE_FRAMES:
+            command += ['-start_number', str(start), output_path]
+        else:
+            command += ['-an', '-c:v', VideoGeneration.CODEC, '-pix_fmt', 'yuv420p', '-r', str(frame_rate), output_path]
+        with tracing.span('encode filtergraph', images=len(spans), frames=end - start):
+            subprocess.run(command, check=True)
+
+
+def render_ffmpeg(rows: List[Tuple[float, str, str]], audio_files: List, output_path: str):
+    """
+    Render the video with ffmpeg filtergraphs, without passing frames through Python.
+
+    The timeline is split at image boundaries into chunks of VideoGeneration.CHUNK_IMAGES images,
+    each rendered by its own ffmpeg process (up to VideoGeneration.RENDER_WORKERS at once) so memory
+    stays bounded however many images the video has. The chunks are then joined with ffmpeg's concat
+    demuxer without re-encoding, and the audio is added in the same pass.
+    """
+    compositor = FrameCompositor(rows)
+    chunks = get_chunks(compositor)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if VideoGeneration.GENERATE_FRAMES:
+            chunk_paths = [output_path] * len(chunks)
+        else:
+            chunk_paths = [os.path.join(temp_dir, f'{index}.mp4') for index in range(len(chunks))]
+        with ThreadPoolExecutor(max_workers=max(VideoGeneration.RENDER_WORKERS, 1)) as executor:
+            futures = [executor.submit(render_segment, rows, start, end, path)
+                       for (start, end), path in zip(chunks, chunk_paths)]
+            for index, future in enumerate(as_completed(futures)):
+                future.result()
+                print_progress_bar(index + 1, len(chunks), "chunks rendered")
+        print_progress_bar(len(chunks), len(chunks), "chunks rendered\n")
+        if VideoGeneration.GENERATE_FRAMES:
+            return
+
+        # Join the chunks without re-encoding them, adding the audio
+        list_path = os.path.join(temp_dir, 'chunks.txt')
+        write_concat_list(chunk_paths, list_path)
+        command = [FFMPEG_BINARY, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+        command += get_audio_arguments(rows, audio_files, temp_dir)
+        command += ['-c:v', 'copy', '-c:a', 'aac', '-t', str(compositor.duration), output_path]
+        with tracing.span('encode concat', chunks=len(chunks)):
+            subprocess.run(command, check=True)
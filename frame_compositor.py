@@ -0,0 +1,365 @@
+import math
+import os
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, NamedTuple, Tuple
+import numpy as np
+import tracing
+from moviepy.config import FFMPEG_BINARY
+from PIL import Image
+from audio_assembler import assemble_audio
+from cache import digest
+import settings
+from settings import VideoGeneration, Pipeline
+from subtitle_cache import get_subtitle_bitmap, get_subtitle_height
+from utility import print_progress_bar
+
+
+class ImageSpan(NamedTuple):
+    start: float # Time the image starts fading in
+    duration: float # Time until the next image starts fading in
+    name: str
+
+
+def get_image_spans(rows: List[Tuple[float, str, str]]) -> List[ImageSpan]:
+    """Group rows by the image shown during them, each image lasting until the next row with an image."""
+    spans = []
+    total_duration = 0
+    for i in range(len(rows)):
+        duration, image_name, _ = rows[i]
+        if image_name:
+            j = i + 1
+            while j < len(rows) and not rows[j][1]:
+                duration += rows[j][0]
+                j += 1
+            spans.append(ImageSpan(total_duration, duration, image_name))
+            total_duration += duration
+    return spans
+
+
+def get_image_path(image_name: str) -> str:
+    image_path = f'{settings.SOURCE_DIRECTORY}/images/{image_name}'
+    if not image_path.endswith(".png"):
+        image_path += ".png"
+    return image_path
+
+
+def load_image(image_name: str) -> np.ndarray:
+    """Load an image as an RGB array resized to the height of the video."""
+    with Image.open(get_image_path(image_name)) as image:
+        image = image.convert('RGB')
+        width = round(image.width * VideoGeneration.HEIGHT / image.height)
+        image = image.resize((width, VideoGeneration.HEIGHT), Image.Resampling.LANCZOS)
+        return np.asarray(image)
+
+
+def blit(frame: np.ndarray, image: np.ndarray, x: int, y: int, alpha: float = 1):
+    """Draw image onto frame with its top left corner at (x, y), blended by alpha."""
+    height, width = image.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, frame.shape[1]), min(y + height, frame.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    source = image[y0 - y:y1 - y, x0 - x:x1 - x]
+    target = frame[y0:y1, x0:x1]
+    if alpha >= 1:
+        target[:] = source
+    else:
+        # Fixed point blend: target + (source - target) * alpha
+        weight = np.uint16(round(alpha * 256))
+        blended = source.astype(np.uint16) * weight
+        blended += target.astype(np.uint16) * (256 - weight)
+        np.right_shift(blended, 8, out=blended)
+        target[:] = blended
+
+
+class FrameCompositor:
+    """
+    Composites frames of the video directly with NumPy.
+
+    The same layout as the moviepy clips in render_clips is computed from a precomputed timeline:
+    each image pans upwards by a slice offset over its duration and crossfades in as a weighted
+    blend with the previous image, and the cached subtitle bitmap of the current row is copied
+    into every frame of the row. Only the images on screen are kept in memory.
+    """
+
+    def __init__(self, rows: List[Tuple[float, str, str]]):
+        self.spans = get_image_spans(rows)
+        self.span_starts = np.array([span.start for span in self.spans])
+        self.row_starts = np.cumsum([0] + [row[0] for row in rows])
+        self.rows = rows
+        self.duration = float(self.row_starts[-1])
+        self.images = {}
+        self.subtitle = (None, None)
+        self.subtitle_height = get_subtitle_height()
+        self.frame = np.zeros((VideoGeneration.HEIGHT, VideoGeneration.WIDTH, 3), dtype=np.uint8)
+
+    def frame_count(self) -> int:
+        return math.ceil(self.duration * VideoGeneration.FRAME_RATE)
+
+    def get_image(self, index: int) -> np.ndarray:
+        if index not in self.images:
+            self.images[index] = load_image(self.spans[index].name)
+        return self.images[index]
+
+    def get_subtitle(self, row: int) -> Tuple[np.ndarray, float]:
+        """Return the subtitle band of a row as RGB and alpha arrays, with alpha None if it's opaque."""
+        if self.subtitle[0] != row:
+            bitmap = get_subtitle_bitmap(self.rows[row][2])
+            alpha = bitmap[:, :, 3:] / 255 if bitmap[:, :, 3].min() < 255 else None
+            self.subtitle = (row, (bitmap[:, :, :3], alpha))
+        return self.subtitle[1]
+
+    def render(self, t: float) -> np.ndarray:
+        """Composite the frame at time t into the shared frame buffer and return it."""
+        frame = self.frame
+        frame.fill(0)
+        crossfade = VideoGeneration.CROSSFADE_DURATION
+        pan_distance = VideoGeneration.HEIGHT * VideoGeneration.SUBTITLE_RATIO
+
+        # Draw the images on screen: the latest image to start, over the one it crossfades from
+        current = int(np.searchsorted(self.span_starts, t, side='right')) - 1
+        for index in [i for i in self.images if i < current - 1]:
+            del self.images[index]
+        for index in range(max(current - 1, 0), current + 1):
+            span = self.spans[index]
+            length = span.duration + crossfade
+            local_t = t - span.start
+            if local_t >= length:
+                continue
+            image = self.get_image(index)
+            x = (VideoGeneration.WIDTH - image.shape[1]) // 2
+            y = round(-(local_t / length) * pan_distance)
+            alpha = min(local_t / crossfade, 1) if index > 0 and crossfade > 0 else 1
+            blit(frame, image, x, y, alpha)
+
+        # Draw the subtitle band of the current row
+        row = int(np.searchsorted(self.row_starts, t, side='right')) - 1
+        if 0 <= row < len(self.rows):
+            band = frame[VideoGeneration.HEIGHT - self.subtitle_height:]
+            rgb, alpha = self.get_subtitle(row)
+            band[:] = rgb if alpha is None else band + (rgb - band.astype(np.float32)) * alpha
+
+        return frame
+
+
+def get_audio_arguments(rows: List[Tuple[float, str, str]], audio_files: List, temp_dir: str,
+                        input_index: int = 1, video: str = '0:v') -> List[str]:
+    """Return ffmpeg arguments adding the assembled soundtrack as input input_index, mapped alongside the given video stream."""
+    audio_path = os.path.join(temp_dir, 'audio.wav')
+    assemble_audio(rows, audio_files, audio_path)
+    return ['-i', audio_path, '-map', video, '-map', f'{input_index}:a']
+
+
+def pipe_frames(rows: List[Tuple[float, str, str]], start: int, end: int, output_arguments: List[str]):
+    """Composite frames start to end and pipe them into an ffmpeg process with the given output arguments."""
+    compositor = FrameCompositor(rows)
+    size = f'{VideoGeneration.WIDTH}x{VideoGeneration.HEIGHT}'
+    command = [FFMPEG_BINARY, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', size, '-r', str(VideoGeneration.FRAME_RATE), '-i', '-']
+
+    # Write each frame straight from the shared buffer without copying it
+    with tracing.span('encode frames', frames=end - start):
+        process = subprocess.Popen(command + output_arguments, stdin=subprocess.PIPE)
+        try:
+            frame_rate = VideoGeneration.FRAME_RATE
+            for n in range(start, end):
+                process.stdin.write(compositor.render(n / frame_rate).data)
+        finally:
+            process.stdin.close()
+            if process.wait() != 0:
+                raise RuntimeError(f"ffmpeg exited with code {process.returncode}")
+
+
+def render_chunk(rows: List[Tuple[float, str, str]], start: int, end: int, output_path: str):
+    """Render frames start to end as a video without audio, or as numbered images when generating frames."""
+    if VideoGeneration.GENERATE_FRAMES:
+        pipe_frames(rows, start, end, ['-start_number', str(start), output_path])
+    else:
+        pipe_frames(rows, start, end, ['-an', '-c:v', VideoGeneration.CODEC, '-pix_fmt', 'yuv420p', output_path])
+
+
+def get_chunks(compositor: FrameCompositor) -> List[Tuple[int, int]]:
+    """Split the frames at image boundaries into chunks of VideoGeneration.CHUNK_IMAGES images."""
+    boundaries = [0]
+    for span in compositor.spans[VideoGeneration.CHUNK_IMAGES::VideoGeneration.CHUNK_IMAGES]:
+        boundary = math.ceil(span.start * VideoGeneration.FRAME_RATE)
+        if boundaries[-1] < boundary < compositor.frame_count():
+            boundaries.append(boundary)
+    boundaries.append(compositor.frame_count())
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def get_visible(starts: np.ndarray, start: int, end: int) -> range:
+    """Return the indices of the timeline entries starting at the given times that are current in frames start to end."""
+    first = int(np.searchsorted(starts, start / VideoGeneration.FRAME_RATE, side='right')) - 1
+    last = int(np.searchsorted(starts, (end - 1) / VideoGeneration.FRAME_RATE, side='right')) - 1
+    return range(max(first, 0), last + 1)
+
+
+def get_chunk_images(compositor: FrameCompositor, start: int, end: int) -> List[str]:
+    """Return the names of the images drawn in frames start to end, including the one the first frame may crossfade from."""
+    visible = get_visible(compositor.span_starts, start, end)
+    return [span.name for span in compositor.spans[max(visible.start - 1, 0):visible.stop]]
+
+
+def get_chunk_directory() -> str:
+    return os.path.join(settings.SOURCE_DIRECTORY, '.cache', 'chunks')
+
+
+def get_chunk_path(compositor: FrameCompositor, start: int, end: int) -> str:
+    """
+    Return the path of frames start to end in the chunk cache, keyed by their position and everything
+    drawn in them: the timing, size and modification time of their images and the timing and text of
+    their subtitles. Raises FileNotFoundError if one of their images doesn't exist.
+    """
+    visible = get_visible(compositor.span_starts, start, end)
+    images = []
+    for span in compositor.spans[max(visible.start - 1, 0):visible.stop]:
+        stat = os.stat(get_image_path(span.name))
+        images.append((span.start, span.duration, span.name, stat.st_size, stat.st_mtime_ns))
+    subtitles = [(float(compositor.row_starts[row]), compositor.rows[row][0], compositor.rows[row][2])
+                 for row in get_visible(compositor.row_starts[:-1], start, end)]
+    video_settings = {k: v for k, v in vars(VideoGeneration).items() if not k.startswith('_')}
+    return os.path.join(get_chunk_directory(), f'{digest(start, end, images, subtitles, video_settings)}.mp4')
+
+
+def render_cached_chunk(rows: List[Tuple[float, str, str]], start: int, end: int, path: str):
+    """Render frames start to end into the chunk cache, moving the chunk into place only once it's complete."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path[:-len('.mp4')] + '.part.mp4'
+    render_chunk(rows, start, end, temp_path)
+    os.replace(temp_path, path)
+
+
+def prune_chunks(keep: List[str]):
+    """Delete every cached chunk that isn't in keep."""
+    keep = {os.path.basename(path) for path in keep}
+    directory = get_chunk_directory()
+    for name in os.listdir(directory):
+        if name not in keep:
+            os.remove(os.path.join(directory, name))
+
+
+class ChunkRenderer:
+    """
+    Renders the chunks of a timeline into the chunk cache in background processes as soon as every
+    image drawn in them is final, so rendering overlaps the generation of later images and the
+    video rendering step only has to join the chunks.
+
+    The worker processes are started when the renderer is created, so it should be created before
+    any other threads are started. No chunk is rendered until start is called with the names of the
+    images that are still to be generated.
+    """
+
+    def __init__(self, rows: List[Tuple[float, str, str]]):
+        self.rows = rows
+        self.compositor = FrameCompositor(rows)
+        self.waiting = [(start, end, {os.path.basename(get_image_path(name)) for name in get_chunk_images(self.compositor, start, end)})
+                        for start, end in get_chunks(self.compositor)]
+        self.pending = None
+        self.futures = []
+        self.lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(max_workers=max(VideoGeneration.RENDER_WORKERS, 1))
+        self.executor.submit(os.getpid).result()
+
+    def start(self, pending: List[str]):
+        """Start rendering the chunks that don't draw any of the pending images."""
+        with self.lock:
+            self.pending = set(pending)
+            self.update()
+
+    def image_ready(self, name: str):
+        """Mark a pending image as final, rendering the chunks that were waiting only for it."""
+        with self.lock:
+            self.pending.discard(name)
+            self.update()
+
+    def update(self):
+        waiting = []
+        for start, end, images in self.waiting:
+            if images & self.pending:
+                waiting.append((start, end, images))
+                continue
+            try:
+                path = get_chunk_path(self.compositor, start, end)
+            except FileNotFoundError:
+                continue # Left for the video rendering step to report
+            if not os.path.isfile(path):
+                self.futures.append(self.executor.submit(render_cached_chunk, self.rows, start, end, path))
+        self.waiting = waiting
+
+    def finish(self) -> int:
+        """Wait for every chunk that was started, returning how many were rendered."""
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+        return len(self.futures)
+
+
+def write_concat_list(paths: List[str], list_path: str):
+    """
+    Write a list of files for ffmpeg's concat demuxer. The paths are made absolute, as ffmpeg resolves
+    relative ones against the list's own directory, and quoted with any single quotes escaped.
+    """
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+
+def render_numpy(rows: List[Tuple[float, str, str]], audio_files: List, output_path: str):
+    """
+    Render the video with the NumPy compositor, piping raw frames into ffmpeg.
+
+    With more than one VideoGeneration.RENDER_WORKERS, or in Pipeline.STREAMING mode, the timeline is
+    split into chunks at image boundaries that are rendered in parallel processes. Each chunk
+    composites its frames from the whole timeline, so crossfades from the previous chunk's last image
+    are drawn as usual. Chunks are kept in a cache keyed by what's drawn in them, so only the chunks
+    that changed since the last render (or weren't already rendered while streaming) are rendered.
+    The chunks are then joined with ffmpeg's concat demuxer without re-encoding, and the audio is
+    added in the same pass.
+    """
+    compositor = FrameCompositor(rows)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if VideoGeneration.RENDER_WORKERS <= 1 and not Pipeline.STREAMING:
+            if VideoGeneration.GENERATE_FRAMES:
+                pipe_frames(rows, 0, compositor.frame_count(), [output_path])
+            else:
+                pipe_frames(rows, 0, compositor.frame_count(), get_audio_arguments(rows, audio_files, temp_dir) + [
+                    '-c:v', VideoGeneration.CODEC, '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+                    '-t', str(compositor.duration), output_path])
+            return
+
+        # Render the chunks that aren't cached in parallel
+        chunks = get_chunks(compositor)
+        if VideoGeneration.GENERATE_FRAMES:
+            render, chunk_paths = render_chunk, [output_path] * len(chunks)
+        else:
+            render, chunk_paths = render_cached_chunk, [get_chunk_path(compositor, start, end) for start, end in chunks]
+        missing = [(chunk, path) for chunk, path in zip(chunks, chunk_paths)
+                   if VideoGeneration.GENERATE_FRAMES or not os.path.isfile(path)]
+        if missing:
+            with ProcessPoolExecutor(max_workers=max(VideoGeneration.RENDER_WORKERS, 1)) as executor:
+                futures = [executor.submit(render, rows, start, end, path) for (start, end), path in missing]
+                for index, future in enumerate(as_completed(futures)):
+                    future.result()
+                    print_progress_bar(index + 1, len(missing), "chunks rendered")
+            print_progress_bar(len(missing), len(missing), "chunks rendered\n")
+        if VideoGeneration.GENERATE_FRAMES:
+            return
+        print(f"{len(chunks) - len(missing)} of {len(chunks)} chunks reused")
+        prune_chunks(chunk_paths)
+
+        # Join the chunks without re-encoding them, adding the audio
+        list_path = os.path.join(temp_dir, 'chunks.txt')
+        write_concat_list(chunk_paths, list_path)
+        command = [FFMPEG_BINARY, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+        command += get_audio_arguments(rows, audio_files, temp_dir)
+        command += ['-c:v', 'copy', '-c:a', 'aac', '-t', str(compositor.duration), output_path]
+        with tracing.span('encode concat', chunks=len(chunks)):
+            subprocess.run(command, check=True)
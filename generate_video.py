@@ -1,13 +1,20 @@
 import glob
 import os
 import shutil
+import sys
+import time
+import traceback
+import settings
+import tracing
 from caption_splitter import split_captions
 from tts_generator import generate_tts
 from script_annotator import annotate_script
 from prompt_generator import generate_scenes, unload_ollama_model
 from image_generator import generate_prompt_images, unload_diffusion_model
 from render_clips import render_clips
-from settings import Pipeline, SOURCE_DIRECTORY, CLEAN
+from streaming import generate_streaming, unload_models
+from cache import Manifest, digest
+from settings import CaptionSplitter, ScriptAnnotation, VideoGeneration, Pipeline, CLEAN
 
 
 def files_exist(*paths):
@@ -34,34 +41,180 @@ def clean(*paths):
                 print(f"  Cleaned {target}")
 
 
-def run_step(name, func, output_paths, post=None):
-    """Run a pipeline step, skipping if outputs exist."""
-    if files_exist(*output_paths):
-        print(f"Skipping {name} (files already exist)")
-        return
-    func()
+def fingerprint(*paths, settings=None):
+    """
+    Return a digest of the given files (supports glob patterns) and settings. Files are identified by
+    their size and modification time rather than their contents, so checking whether a step is up to
+    date doesn't read every audio clip and image.
+    """
+    files = []
+    for path in paths:
+        targets = glob.glob(path) if ('*' in path or '?' in path) else [path]
+        for target in sorted(targets):
+            if os.path.isfile(target):
+                stat = os.stat(target)
+                files.append((target, stat.st_size, stat.st_mtime_ns))
+    if settings is not None:
+        settings = {k: v for k, v in vars(settings).items() if not k.startswith('_')}
+    return digest(files, settings)
+
+
+def run_step(name, func, output_paths, post=None, key=None, incremental=False):
+    """
+    Run a pipeline step, skipping it if its outputs are up to date.
+
+    Without a key, a step is up to date whenever its outputs exist. With a key (a callable
+    returning a digest of the step's inputs), the step also reruns when the digest differs
+    from the one recorded after its last run (outputs from runs that predate the record are
+    adopted as up to date). Incremental steps always run, regenerate only
+    the items whose inputs changed, and return how many items they regenerated.
+
+    Returns True if the step did any work.
+    """
+    steps = Manifest('steps')
+    current = key() if key else None
+    if not incremental and files_exist(*output_paths):
+        if steps.entries.get(name, current) == current:
+            print(f"Skipping {name} (files already exist)")
+            if current:
+                steps.set(name, current)
+                steps.save()
+            return False
+    with tracing.step(name):
+        result = func()
+    if current:
+        steps.set(name, current)
+        steps.save()
+    if result == 0:
+        print(f"Skipping {name} (no changes)")
+        return False
     if post:
         post()
+    return True
 
 
-if __name__ == "__main__":
-    captions = os.path.join(SOURCE_DIRECTORY, 'captions.txt')
-    audio_dir = os.path.join(SOURCE_DIRECTORY, 'audio')
-    script = os.path.join(SOURCE_DIRECTORY, 'script.txt')
-    scenes = os.path.join(SOURCE_DIRECTORY, 'scenes.txt')
-    images_dir = os.path.join(SOURCE_DIRECTORY, 'images')
-    video = os.path.join(SOURCE_DIRECTORY, 'video.mp4')
+def get_steps(streaming=None, batch=False):
+    """
+    Return the steps of the pipeline for the current story as (name, func, output_paths, options)
+    tuples, with options to pass on to run_step. In a batch, the streaming step leaves unloading
+    the models to its post callback, so they're unloaded once the whole batch is past it.
+    """
+    if streaming is None:
+        streaming = Pipeline.STREAMING
+    captions = os.path.join(settings.SOURCE_DIRECTORY, 'captions.txt')
+    audio_dir = os.path.join(settings.SOURCE_DIRECTORY, 'audio')
+    script = os.path.join(settings.SOURCE_DIRECTORY, 'script.txt')
+    scenes = os.path.join(settings.SOURCE_DIRECTORY, 'scenes.txt')
+    images_dir = os.path.join(settings.SOURCE_DIRECTORY, 'images')
+    video = os.path.join(settings.SOURCE_DIRECTORY, 'video.mp4')
+
+    story = os.path.join(settings.SOURCE_DIRECTORY, 'story.txt')
+    audio_clips = os.path.join(audio_dir, '*.wav')
+    packed_audio = os.path.join(audio_dir, 'packed.json')
+    images = os.path.join(images_dir, '*.png')
+    music = os.path.join(settings.SOURCE_DIRECTORY, 'audio.mp3')
+
+    steps = [
+        ('caption splitting', split_captions, [captions],
+         dict(key=lambda: fingerprint(story, settings=CaptionSplitter))),
+        ('TTS generation', generate_tts, [audio_dir], dict(incremental=True)),
+        ('script annotation', annotate_script, [script],
+         dict(key=lambda: fingerprint(captions, audio_clips, packed_audio, settings=ScriptAnnotation))),
+    ]
+    if streaming:
+        if batch:
+            steps.append(('streaming generation', lambda: generate_streaming(unload=False), [scenes, images_dir],
+                          dict(incremental=True, post=unload_models)))
+        else:
+            steps.append(('streaming generation', generate_streaming, [scenes, images_dir], dict(incremental=True)))
+    else:
+        steps.append(('scene generation', generate_scenes, [scenes],
+                      dict(incremental=True, post=unload_ollama_model if Pipeline.DYNAMICALLY_UNLOAD_OLLAMA else None)))
+        steps.append(('image generation', generate_prompt_images, [images_dir],
+                      dict(incremental=True, post=unload_diffusion_model if Pipeline.DYNAMICALLY_UNLOAD_COMFYUI else None)))
+    steps.append(('video rendering', render_clips, [video],
+                  dict(key=lambda: fingerprint(script, audio_clips, packed_audio, images, music, settings=VideoGeneration))))
+    return steps
+
 
-    all_outputs = [captions, audio_dir, script, scenes, images_dir, video]
+def clean_story():
+    """Delete the generated files of the current story."""
+    outputs = ['captions.txt', 'audio', 'script.txt', 'scenes.txt', 'images', 'video.mp4', '.cache']
+    clean(*[os.path.join(settings.SOURCE_DIRECTORY, output) for output in outputs])
+
+
+def read_jobs(path):
+    """Return the stories listed in a job file, one per line, ignoring blank lines and # comments."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+def run_batch(stories):
+    """
+    Run the pipeline on several stories in one process a stage at a time, so each model is loaded
+    once per batch instead of once per story, and unloaded once every story is past its stage.
+
+    Streaming mode is used only if the LLM and ComfyUI don't share a GPU, as each story would
+    otherwise have to unload the LLM before its images. A story whose step fails is skipped in the remaining stages.
+    Returns a dict of the error of each failed story.
+    """
+    streaming = Pipeline.STREAMING and not Pipeline.SHARED_GPU
+    failed = {}
+    durations = dict.fromkeys(stories, 0.0)
+    for story in stories:
+        settings.set_story(story)
+        if CLEAN:
+            clean_story()
+        tracing.start()
+
+    for stage in range(len(get_steps(streaming, batch=True))):
+        unload, worked = None, False
+        for story in stories:
+            if story in failed:
+                continue
+            settings.set_story(story)
+            name, func, output_paths, options = get_steps(streaming, batch=True)[stage]
+            unload = options.pop('post', None)
+            print(f"\n[{story}] {name}")
+            start = time.perf_counter()
+            try:
+                worked |= bool(run_step(name, func, output_paths, **options))
+            except Exception as e:
+                traceback.print_exc()
+                failed[story] = f"{name} failed: {e}"
+            durations[story] += time.perf_counter() - start
+        if unload and worked:
+            unload()
+
+    for story in stories:
+        settings.set_story(story)
+        tracing.print_summary()
+    print("\nBatch results:")
+    for story in stories:
+        print(f"  {story}: {failed.get(story, 'done')} ({durations[story]:.1f}s)")
+    return failed
+
+
+def main():
+    if len(settings.STORIES) > 1 or settings.JOBS:
+        # Run the stories given as a batch, then any added to the job file in the meantime until there are none
+        stories = list(dict.fromkeys(settings.STORIES + (read_jobs(settings.JOBS) if settings.JOBS else [])))
+        done, failed = set(), {}
+        while stories:
+            failed.update(run_batch(stories))
+            done.update(stories)
+            stories = list(dict.fromkeys(story for story in read_jobs(settings.JOBS) if story not in done)) if settings.JOBS else []
+        if failed:
+            sys.exit(1)
+        return
 
     if CLEAN:
-        clean(*all_outputs)
-
-    run_step('caption splitting', split_captions, [captions])
-    run_step('TTS generation', generate_tts, [audio_dir])
-    run_step('script annotation', annotate_script, [script])
-    run_step('scene generation', generate_scenes, [scenes],
-             post=unload_ollama_model if Pipeline.DYNAMICALLY_UNLOAD_OLLAMA else None)
-    run_step('image generation', generate_prompt_images, [images_dir],
-             post=unload_diffusion_model if Pipeline.DYNAMICALLY_UNLOAD_COMFYUI else None)
-    run_step('video rendering', render_clips, [video])
\ No newline at end of file
+        clean_story()
+    tracing.start()
+    for name, func, output_paths, options in get_steps():
+        run_step(name, func, output_paths, **options)
+    tracing.print_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,157 +1,145 @@
 import json
 import os
+import queue
 import random
-import uuid
-import urllib.parse
+import threading
 import urllib.request
-import websocket
+from cache import Manifest, digest, file_digest, remap_files
+from comfy_client import ComfyPool
 from utility import print_progress_bar
-from settings import ImageGeneration, SOURCE_DIRECTORY
-
-
-def get_base_url():
-    return f"http://{ImageGeneration.HOST}:{ImageGeneration.PORT}"
-
-
-def get_ws_url(client_id):
-    return f"ws://{ImageGeneration.HOST}:{ImageGeneration.PORT}/ws?clientId={client_id}"
+import settings
+from settings import ImageGeneration
+
+
+def get_endpoints():
+    """Return the (host, port) of every configured ComfyUI server."""
+    if not ImageGeneration.SERVERS:
+        return [(ImageGeneration.HOST, ImageGeneration.PORT)]
+    endpoints = []
+    for server in ImageGeneration.SERVERS:
+        host, _, port = server.rpartition(':')
+        endpoints.append((host, int(port)))
+    return endpoints
+
+
+LATENT_IMAGE_CLASSES = ["EmptySD3LatentImage", "EmptyLatentImage", "EmptyFlux2LatentImage"]
+
+
+class WorkflowTemplate:
+    """
+    A ComfyUI workflow parsed once, with the node inputs to set for each image resolved ahead of
+    time into a patch plan of (node_id, input_key) targets.
+
+    With websocket_outputs, SaveImage nodes are replaced by SaveImageWebsocket nodes so images
+    are sent back over the WebSocket instead of being saved on the server; their node IDs are
+    listed in self.websocket_outputs.
+
+    Raises ValueError if the workflow has nowhere to set the prompt text or the image size,
+    or no image output to send over the WebSocket.
+    """
+
+    def __init__(self, workflow, name='workflow', websocket_outputs=False):
+        self.workflow = workflow
+        self.websocket_outputs = []
+        self.prompt_targets = []
+        self.width_targets = []
+        self.height_targets = []
+        self.seed_targets = []
+
+        for node_id, node in workflow.items():
+            class_type = node.get("class_type")
+            inputs = node.get("inputs", {})
+            title = node.get("_meta", {}).get("title")
+
+            # Prompt text on CLIPTextEncode nodes that have a direct string text input,
+            # and on PrimitiveStringMultiline nodes (used as prompt sources)
+            if class_type == "CLIPTextEncode" and isinstance(inputs.get("text"), str):
+                self.prompt_targets.append((node_id, "text"))
+            elif class_type == "PrimitiveStringMultiline" and "value" in inputs:
+                self.prompt_targets.append((node_id, "value"))
+
+            # Dimensions on latent image nodes with direct integer inputs,
+            # and on PrimitiveInt nodes titled "Width" or "Height"
+            elif class_type in LATENT_IMAGE_CLASSES:
+                if isinstance(inputs.get("width"), int):
+                    self.width_targets.append((node_id, "width"))
+                if isinstance(inputs.get("height"), int):
+                    self.height_targets.append((node_id, "height"))
+            elif class_type == "PrimitiveInt" and title == "Width":
+                self.width_targets.append((node_id, "value"))
+            elif class_type == "PrimitiveInt" and title == "Height":
+                self.height_targets.append((node_id, "value"))
+
+            # Seeds on KSampler and RandomNoise nodes
+            elif class_type == "KSampler":
+                self.seed_targets.append((node_id, "seed"))
+            elif class_type == "RandomNoise":
+                self.seed_targets.append((node_id, "noise_seed"))
+
+            # Image outputs sent over the WebSocket
+            elif websocket_outputs and class_type in ["SaveImage", "SaveImageWebsocket"]:
+                workflow[node_id] = {**node, "class_type": "SaveImageWebsocket", "inputs": {"images": inputs["images"]}}
+                self.websocket_outputs.append(node_id)
+
+        missing = []
+        if not self.prompt_targets:
+            missing.append("prompt text (a CLIPTextEncode node with a text string, or a PrimitiveStringMultiline node)")
+        if not self.width_targets or not self.height_targets:
+            dimension = 'height' if self.width_targets else 'width' if self.height_targets else 'size'
+            missing.append(f"image {dimension} (an {', '.join(LATENT_IMAGE_CLASSES)} node with integer inputs, "
+                           "or PrimitiveInt nodes titled 'Width' and 'Height')")
+        if websocket_outputs and not self.websocket_outputs:
+            missing.append("image output (a SaveImage or SaveImageWebsocket node)")
+        if missing:
+            raise ValueError(f"{name} has nowhere to set the " + " or the ".join(missing))
+
+    def render(self, prompt, width, height, seed=None):
+        """Return a copy of the workflow with the given prompt text, image dimensions and seed applied."""
+        if seed is None:
+            seed = random.randint(0, 2**63)
+        values = [(self.prompt_targets, prompt), (self.width_targets, width),
+                  (self.height_targets, height), (self.seed_targets, seed)]
+
+        # Copy only the nodes that are patched, sharing the rest with the template
+        workflow = dict(self.workflow)
+        for targets, value in values:
+            for node_id, key in targets:
+                node = workflow[node_id]
+                if node is self.workflow[node_id]:
+                    node = workflow[node_id] = {**node, "inputs": dict(node["inputs"])}
+                node["inputs"][key] = value
+        return workflow
 
 
 def load_workflow():
-    """Load the ComfyUI workflow from the configured JSON file."""
+    """Load and compile the ComfyUI workflow from the configured JSON file."""
     with open(ImageGeneration.WORKFLOW, 'r', encoding='utf-8') as f:
-        return json.load(f)
+        return WorkflowTemplate(json.load(f), os.path.basename(ImageGeneration.WORKFLOW),
+                                websocket_outputs=ImageGeneration.TRANSFER == 'websocket')
 
 
-def find_nodes_by_class(workflow, class_type):
-    """Find all node IDs with the given class_type."""
-    return [nid for nid, node in workflow.items() if node.get("class_type") == class_type]
-
-
-def find_nodes_by_title(workflow, title):
-    """Find all node IDs whose _meta.title matches the given title."""
-    return [nid for nid, node in workflow.items()
-            if node.get("_meta", {}).get("title") == title]
-
-
-def configure_workflow(workflow, prompt, width, height):
-    """Configure the workflow with the given prompt text and image dimensions."""
-
-    # Set the prompt text on CLIPTextEncode nodes that have a direct string text input
-    for node_id in find_nodes_by_class(workflow, "CLIPTextEncode"):
-        if isinstance(workflow[node_id]["inputs"].get("text"), str):
-            workflow[node_id]["inputs"]["text"] = prompt
-
-    # Set the prompt text on PrimitiveStringMultiline nodes (used as prompt sources)
-    for node_id in find_nodes_by_class(workflow, "PrimitiveStringMultiline"):
-        if "value" in workflow[node_id]["inputs"]:
-            workflow[node_id]["inputs"]["value"] = prompt
-
-    # Set dimensions on latent image nodes with direct integer inputs
-    for class_type in ["EmptySD3LatentImage", "EmptyLatentImage", "EmptyFlux2LatentImage"]:
-        for node_id in find_nodes_by_class(workflow, class_type):
-            inputs = workflow[node_id]["inputs"]
-            if isinstance(inputs.get("width"), int):
-                inputs["width"] = width
-            if isinstance(inputs.get("height"), int):
-                inputs["height"] = height
-
-    # Set dimensions on PrimitiveInt nodes titled "Width" or "Height"
-    for node_id in find_nodes_by_title(workflow, "Width"):
-        if workflow[node_id]["class_type"] == "PrimitiveInt":
-            workflow[node_id]["inputs"]["value"] = width
-    for node_id in find_nodes_by_title(workflow, "Height"):
-        if workflow[node_id]["class_type"] == "PrimitiveInt":
-            workflow[node_id]["inputs"]["value"] = height
-
-    # Randomize seed on KSampler nodes
-    for node_id in find_nodes_by_class(workflow, "KSampler"):
-        workflow[node_id]["inputs"]["seed"] = random.randint(0, 2**63)
-
-    # Randomize seed on RandomNoise nodes
-    for node_id in find_nodes_by_class(workflow, "RandomNoise"):
-        workflow[node_id]["inputs"]["noise_seed"] = random.randint(0, 2**63)
-
-    return workflow
-
-
-def queue_prompt(workflow, client_id):
-    """Queue a prompt with ComfyUI and return the prompt_id."""
-    url = f"{get_base_url()}/prompt"
-    data = json.dumps({"prompt": workflow, "client_id": client_id}).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
-    with urllib.request.urlopen(req) as response:
-        return json.loads(response.read())["prompt_id"]
-
-
-def wait_for_completion(ws, prompt_id):
-    """Listen on the WebSocket until the given prompt finishes executing."""
-    while True:
-        message = ws.recv()
-        if isinstance(message, str):
-            data = json.loads(message)
-            if data.get("type") == "executing":
-                exec_data = data.get("data", {})
-                if exec_data.get("prompt_id") == prompt_id and exec_data.get("node") is None:
-                    return
-
-
-def get_history(prompt_id):
-    """Fetch the execution history for a completed prompt."""
-    url = f"{get_base_url()}/history/{prompt_id}"
-    with urllib.request.urlopen(url) as response:
-        return json.loads(response.read())[prompt_id]
-
-
-def download_image(filename, subfolder="", image_type="output"):
-    """Download a generated image from ComfyUI's /view endpoint."""
-    params = urllib.parse.urlencode({"filename": filename, "subfolder": subfolder, "type": image_type})
-    url = f"{get_base_url()}/view?{params}"
-    with urllib.request.urlopen(url) as response:
-        return response.read()
-
-
-def generate_image(prompt: str, name: str, ws, client_id):
-    """Generate a single image using the ComfyUI workflow and save it locally."""
-    workflow = load_workflow()
-    workflow = configure_workflow(workflow, prompt, ImageGeneration.WIDTH, ImageGeneration.HEIGHT)
-
-    prompt_id = queue_prompt(workflow, client_id)
-    wait_for_completion(ws, prompt_id)
-    history = get_history(prompt_id)
-
-    # Extract the output image from the execution history
-    outputs = history.get("outputs", {})
-    for node_id, node_output in outputs.items():
-        if "images" in node_output:
-            for image_info in node_output["images"]:
-                image_data = download_image(
-                    image_info["filename"],
-                    image_info.get("subfolder", "")
-                )
-                images_directory = os.path.join(SOURCE_DIRECTORY, "images")
-                os.makedirs(images_directory, exist_ok=True)
-                save_path = os.path.join(images_directory, f"{name}.png")
-                with open(save_path, "wb") as f:
-                    f.write(image_data)
-                return  # Save only the first image
+def get_seed(prompt):
+    """Return the seed for the given prompt, derived from ImageGeneration.SEED if set."""
+    if ImageGeneration.SEED is None:
+        return random.randint(0, 2**63)
+    return int(digest(ImageGeneration.SEED, prompt)[:15], 16)
 
 
 def unload_diffusion_model():
-    """Free GPU memory by unloading models in ComfyUI."""
-    url = f"{get_base_url()}/free"
+    """Free GPU memory by unloading models on every ComfyUI server."""
     data = json.dumps({"unload_models": True, "free_memory": True}).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
-    try:
-        urllib.request.urlopen(req)
-    except Exception:
-        pass
+    for host, port in get_endpoints():
+        req = urllib.request.Request(f"http://{host}:{port}/free", data=data, headers={"Content-Type": "application/json"})
+        try:
+            urllib.request.urlopen(req)
+        except Exception:
+            pass
 
 
 def get_prompts():
 
     # Read the scene file
-    path = os.path.join(SOURCE_DIRECTORY, 'scenes.txt')
+    path = os.path.join(settings.SOURCE_DIRECTORY, 'scenes.txt')
     with open(path, 'r', encoding='utf-8') as file:
         scenes = file.readlines()
     scenes = [scene.strip() for scene in scenes if scene.strip()]
@@ -159,19 +147,114 @@ def get_prompts():
     return scenes
 
 
+class ImageQueue:
+    """
+    Generates the images of prompts as they're put in the queue, reusing the images whose prompt,
+    workflow and seed haven't changed.
+
+    Prompts that aren't known yet (e.g. scenes still being written) are given as None, and their
+    images are always regenerated. Images are submitted to the ComfyUI servers from a background
+    thread so put never blocks, and on_image, if provided, is called with the index of each image
+    once it's saved. Each saved image is logged in the manifest, which is saved once the queue is
+    finished or closed.
+    """
+
+    def __init__(self, prompts, on_image=None):
+        self.template = load_workflow()
+        self.images_directory = os.path.join(settings.SOURCE_DIRECTORY, "images")
+        self.workflow_digest = file_digest(ImageGeneration.WORKFLOW)
+        self.keys = [self.get_key(prompt) if prompt is not None else None for prompt in prompts]
+        self.manifest = Manifest('images')
+        sources = self.manifest.plan(self.keys, lambda index: os.path.isfile(self.image_path(index)))
+        sources = [source if key is not None else None for key, source in zip(self.keys, sources)]
+        remap_files(self.images_directory, 'png', sources)
+        self.manifest.reset(self.keys, sources)
+        self.pending = [index for index, source in enumerate(sources) if source is None]
+        self.on_image = on_image
+        self.requests = queue.Queue()
+        self.futures = []
+        self.completed = 0
+        self.error = None
+        self.lock = threading.Lock()
+        self.pool = None
+        self.thread = None
+
+    def image_path(self, index):
+        return os.path.join(self.images_directory, f"{index}.png")
+
+    def get_key(self, prompt):
+        return digest(prompt, self.workflow_digest, ImageGeneration.WIDTH, ImageGeneration.HEIGHT, ImageGeneration.SEED)
+
+    def put(self, index, prompt):
+        """Queue the image of a pending prompt."""
+        self.keys[index] = self.get_key(prompt)
+        if self.pool is None:
+            # Keep every server's queue full while finished images are saved in the background
+            self.pool = ComfyPool(get_endpoints(), ImageGeneration.QUEUE_DEPTH, ImageGeneration.DOWNLOAD_WORKERS,
+                                  ImageGeneration.RETRIES, ImageGeneration.HEALTH_INTERVAL,
+                                  transfer=ImageGeneration.TRANSFER, websocket_outputs=self.template.websocket_outputs)
+            self.thread = threading.Thread(target=self.submit_requests, daemon=True)
+            self.thread.start()
+            print_progress_bar(0, len(self.pending), "images generated")
+        self.requests.put((index, prompt))
+
+    def submit_requests(self):
+        try:
+            while (request := self.requests.get()) is not None:
+                index, prompt = request
+                workflow = self.template.render(prompt, ImageGeneration.WIDTH, ImageGeneration.HEIGHT, get_seed(prompt))
+                future = self.pool.submit(workflow, self.image_path(index))
+                self.futures.append(future)
+                future.add_done_callback(lambda future, index=index: self.record(index, future))
+        except Exception as e:
+            self.error = e
+
+    def record(self, index, future):
+        if future.cancelled() or future.exception():
+            return # Raised by finish
+        with self.lock:
+            self.manifest.record(index, self.keys[index])
+            self.completed += 1
+            print_progress_bar(self.completed, len(self.pending), "images generated")
+        if self.on_image:
+            self.on_image(index)
+
+    def finish(self):
+        """Wait for every queued image, returning how many were generated."""
+        if self.pool is None: return 0
+        try:
+            self.requests.put(None)
+            self.thread.join()
+            if self.error:
+                raise self.error
+            for future in self.futures:
+                future.result()
+            print_progress_bar(self.completed, len(self.pending), "images generated\n")
+        finally:
+            self.pool.close()
+            self.save()
+        self.pool.print_stats()
+        return len(self.futures)
+
+    def save(self):
+        """Merge the images logged since the last save into the manifest."""
+        with self.lock:
+            self.manifest.save()
+
+    def close(self):
+        """Stop submitting images if finish wasn't reached, abandoning any still queued."""
+        if self.thread is not None and self.thread.is_alive():
+            self.requests.put(None)
+            self.pool.close()
+            self.save()
+
+
 def generate_prompt_images():
     prompts = get_prompts()
-    count = len(prompts)
-    client_id = str(uuid.uuid4())
-    ws = websocket.WebSocket()
-    ws.connect(get_ws_url(client_id))
-    try:
-        for index, scene in enumerate(prompts):
-            print_progress_bar(index, count, "images generated")
-            generate_image(scene, str(index), ws, client_id)
-        print_progress_bar(count, count, "images generated\n")
-    finally:
-        ws.close()
+    images = ImageQueue(prompts)
+    for index in images.pending:
+        images.put(index, prompts[index])
+    return images.finish()
 
 
 if __name__ == "__main__":
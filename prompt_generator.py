@@ -1,13 +1,22 @@
+import json
 import os
+import re
 import requests
 import socket
 import subprocess
-from settings import PromptGeneration, SOURCE_DIRECTORY
+import threading
+import time
+import tracing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
+from cache import Manifest, ResponseCache, digest
+import settings
+from settings import PromptGeneration
 from utility import parse_lines, print_progress_bar
 
 
 def get_image_segments():
-    lines = [(line[1], line[2]) for line in parse_lines()]
+    lines = [(line.image, line.text) for line in parse_lines()]
     segments = []
     current_segment = ''
     for line in lines:
@@ -19,23 +28,204 @@ def get_image_segments():
     return segments
 
 
-def get_text_prompt(line_index: int, template: str, lines) -> str:
+def get_text_prompt(line_index: int, template: str, lines, window: int = None, summary: str = '') -> str:
 
-    # Get the requested line and the lines before and after
+    # Get the requested line and the lines before and after, limited to the window if provided
     line = lines[line_index]
-    before = '\n'.join(lines[:line_index])
-    after = '\n'.join(lines[line_index+1:])
+    start = 0 if window is None else max(0, line_index - window)
+    end = len(lines) if window is None else line_index + 1 + window
+    before = '\n'.join(lines[start:line_index])
+    after = '\n'.join(lines[line_index+1:end])
 
     # Replace placeholders in template
     formatted = template.replace('<LINE>', line)
     formatted = formatted.replace('<BEFORE>', before)
     formatted = formatted.replace('<AFTER>', after)
+    formatted = formatted.replace('<SUMMARY>', summary)
 
     return formatted
 
 
-def get_response(text_prompt: str) -> str:
+def get_scene_key(line_index: int, template: str, lines, window: int = None) -> str:
+    """
+    Return the key of a segment's description: a digest of its prompt with at most
+    PromptGeneration.KEY_WINDOW neighbouring segments on each side and no summary, along with the
+    model. Editing the story then only regenerates the descriptions of the segments near the edit,
+    even when each prompt holds the whole story.
+    """
+    key_window = PromptGeneration.KEY_WINDOW if window is None else min(window, PromptGeneration.KEY_WINDOW)
+    text_prompt = get_text_prompt(line_index, template, lines, key_window)
+    return digest(text_prompt, PromptGeneration.USE_OLLAMA, PromptGeneration.MODEL)
 
+
+def get_batch_prompt(indices: List[int], template: str, lines, window: int = None, summary: str = '') -> str:
+
+    # Number the requested consecutive lines, and get the lines before and after them limited to the window if provided
+    first, last = indices[0], indices[-1]
+    start = 0 if window is None else max(0, first - window)
+    end = len(lines) if window is None else last + 1 + window
+    segments = '\n\n'.join(f'[{number + 1}] {lines[index].strip()}' for number, index in enumerate(indices))
+    before = '\n'.join(lines[start:first])
+    after = '\n'.join(lines[last+1:end])
+
+    # Replace placeholders in template
+    formatted = template.replace('<SEGMENTS>', segments)
+    formatted = formatted.replace('<COUNT>', str(len(indices)))
+    formatted = formatted.replace('<BEFORE>', before)
+    formatted = formatted.replace('<AFTER>', after)
+    formatted = formatted.replace('<SUMMARY>', summary)
+
+    return formatted
+
+
+def get_scene_schema(count: int) -> dict:
+    """Return the JSON schema of an object mapping the numbers 1 to count to a description each."""
+    numbers = [str(number + 1) for number in range(count)]
+    return {
+        "type": "object",
+        "properties": {number: {"type": "string"} for number in numbers},
+        "required": numbers,
+        "additionalProperties": False
+    }
+
+
+def parse_scene_batch(response: str, count: int) -> Dict[int, str]:
+    """
+    Return the non-empty descriptions in a batched response by their position in the batch, each
+    flattened to one line like single-scene responses. Raises ValueError if the response isn't a
+    JSON object.
+    """
+    scenes = json.loads(response)
+    if not isinstance(scenes, dict):
+        raise ValueError(f"Expected a JSON object of scenes, got {type(scenes).__name__}")
+    valid = {}
+    for position in range(count):
+        scene = scenes.get(str(position + 1))
+        if isinstance(scene, str) and scene.strip():
+            valid[position] = scene.replace("\n", " ").strip()
+    return valid
+
+
+def get_runs(indices: List[int], size: int = None) -> List[List[int]]:
+    """Split sorted indices into runs of consecutive indices, each at most size long."""
+    runs = []
+    for index in indices:
+        if runs and runs[-1][-1] == index - 1 and (size is None or len(runs[-1]) < size):
+            runs[-1].append(index)
+        else:
+            runs.append([index])
+    return runs
+
+
+def get_scene_batch(indices: List[int], get_prompt, retry: bool = True) -> Dict[int, str]:
+    """
+    Describe consecutive segments in one request with structured output, returning their scenes by index.
+    get_prompt returns the prompt for a list of indices, a batch prompt unless there's only one.
+
+    Segments that are missing or empty in the response are requested again once as smaller
+    batches, then one at a time, and every segment is requested one at a time if the response
+    can't be parsed.
+    """
+    if len(indices) == 1:
+        return {indices[0]: get_response(get_prompt(indices))}
+    try:
+        found = parse_scene_batch(get_response(get_prompt(indices), get_scene_schema(len(indices))), len(indices))
+    except ValueError: # Including JSON decode errors
+        found, retry = {}, False
+    scenes = {indices[position]: scene for position, scene in found.items()}
+    for run in get_runs([index for index in indices if index not in scenes]):
+        if retry:
+            scenes.update(get_scene_batch(run, get_prompt, retry=False))
+        else:
+            scenes.update((index, get_response(get_prompt([index]))) for index in run)
+    return scenes
+
+
+def get_story_summary(lines) -> str:
+    """
+    Summarize the story by folding it into a rolling summary one chunk of segments at a time,
+    so that each request only holds the summary so far and the next chunk.
+    """
+    with open('summary_template.txt', 'r', encoding='utf-8') as file:
+        summary_template = file.read()
+
+    summary = ''
+    chunks = range(0, len(lines), PromptGeneration.SUMMARY_CHUNK)
+    for i, start in enumerate(chunks):
+        print_progress_bar(i, len(chunks), 'story parts summarized')
+        text = '\n'.join(lines[start:start + PromptGeneration.SUMMARY_CHUNK])
+        text_prompt = summary_template.replace('<TEXT>', text).replace('<SUMMARY>', summary or '(The story has just begun.)')
+        summary = get_response(text_prompt)
+    print_progress_bar(len(chunks), len(chunks), 'story parts summarized\n')
+
+    return summary
+
+
+_session = None
+_session_lock = threading.Lock()
+_response_cache = None
+
+
+def get_session() -> requests.Session:
+    """Return the HTTP session shared by all requests, pooling one connection per concurrent request."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(PromptGeneration.CONCURRENCY, 1))
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def get_response_cache() -> ResponseCache:
+    """Return the response cache shared by all requests."""
+    global _response_cache
+    with _session_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                PromptGeneration.CACHE_PATH,
+                PromptGeneration.CACHE_SIZE * 1024 * 1024,
+                enabled=PromptGeneration.CACHE_RESPONSES)
+        return _response_cache
+
+
+class StreamStats:
+    """Running totals of the time to first token and generation rate of streamed responses."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.first_token_times = []
+            self.tokens = 0
+            self.seconds = 0.0
+            self.cutoffs = 0
+
+    def add(self, first_token_time: float, tokens: int, seconds: float, cutoff: bool):
+        with self.lock:
+            self.first_token_times.append(first_token_time)
+            self.tokens += tokens
+            self.seconds += seconds
+            self.cutoffs += cutoff
+
+    def __str__(self):
+        with self.lock:
+            if not self.first_token_times:
+                return "no streamed responses"
+            first_token_times = sorted(self.first_token_times)
+            rate = self.tokens / self.seconds if self.seconds else 0
+            return (f"{len(first_token_times)} streamed, median time to first token {first_token_times[len(first_token_times) // 2]:.2f}s, "
+                    f"{rate:.1f} tokens/s, {self.cutoffs} cut off by a budget")
+
+
+_stream_stats = StreamStats()
+
+
+def get_request(text_prompt: str, schema: dict = None):
+    """Return the URL, headers, body and whether to verify TLS of a request for a prompt's response."""
     if PromptGeneration.USE_OLLAMA:
         url = f'http://{PromptGeneration.HOST}:{PromptGeneration.PORT}/api/generate'
         data = {
@@ -43,34 +233,197 @@ def get_response(text_prompt: str) -> str:
             "prompt": text_prompt,
             "stream": False,
             "options": {
-                "num_ctx": 16384
+                "num_ctx": PromptGeneration.CONTEXT_LENGTH
             }
         }
-        response = requests.post(url, json=data)
-        result = response.json()['response']
-
-    else: # OpenAI chat completions API
-        secure = PromptGeneration.PORT in [443, None]
-        url = f"{f'https' if secure else 'http'}://{PromptGeneration.HOST}{'' if secure else f':{PromptGeneration.PORT}'}/v1/chat/completions"
-        headers = { 
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {PromptGeneration.API_KEY}" if PromptGeneration.API_KEY else ""
-        }
-        history = [{"role": "user", "content": text_prompt}]
-        data = {
-            "model": PromptGeneration.MODEL,
-            "messages": history,
-            "max_tokens": 2048
-        }
-        response = requests.post(url, headers=headers, json=data, verify=False)
-        result = response.json()['choices'][0]['message']['content']
+        if schema is not None:
+            data["format"] = schema
+        return url, None, data, True
 
-    # Filter out CoT in reasoning models
+    # OpenAI chat completions API
+    secure = PromptGeneration.PORT in [443, None]
+    url = f"{f'https' if secure else 'http'}://{PromptGeneration.HOST}{'' if secure else f':{PromptGeneration.PORT}'}/v1/chat/completions"
+    headers = { 
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {PromptGeneration.API_KEY}" if PromptGeneration.API_KEY else ""
+    }
+    history = [{"role": "user", "content": text_prompt}]
+    data = {
+        "model": PromptGeneration.MODEL,
+        "messages": history,
+        "max_tokens": 2048
+    }
+    if schema is not None:
+        data["response_format"] = {"type": "json_schema", "json_schema": {"name": "scenes", "schema": schema, "strict": True}}
+    return url, headers, data, False
+
+
+def parse_stream_line(line: bytes):
+    """Return the reasoning text, answer text and whether the stream is done for a line of a streamed response."""
+    if PromptGeneration.USE_OLLAMA:
+        body = json.loads(line)
+        return body.get('thinking') or '', body.get('response') or '', body.get('done', False)
+    if not line.startswith(b'data:'):
+        return '', '', False
+    payload = line[len(b'data:'):].strip()
+    if payload == b'[DONE]':
+        return '', '', True
+    choices = json.loads(payload).get('choices') or [{}]
+    delta = choices[0].get('delta') or {}
+    thinking = delta.get('reasoning_content') or delta.get('reasoning') or ''
+    return thinking, delta.get('content') or '', choices[0].get('finish_reason') is not None
+
+
+def trim_to_sentence(text: str) -> str:
+    """Cut text back to the end of its last complete sentence, if it has one."""
+    match = re.match(r'.*[.!?]["\')\]]*', text, re.DOTALL)
+    return match.group(0) if match else text
+
+
+def get_sentence_ends(text: str) -> List[int]:
+    """Return the positions just after each sentence of text that's known to be complete, as text follows it."""
+    return [match.end() for match in re.finditer(r'[.!?]["\')\]]*(?=\s)', text)]
+
+
+class ThinkBudgetExceeded(Exception):
+    pass
+
+
+def stream_response(url: str, headers, data: dict, verify: bool, attributes: dict, answers: int = None,
+                    think_budget: bool = True) -> str:
+    """
+    Stream a response, returning its answer (which may still hold reasoning in <think> tags).
+
+    Generation is stopped once the reasoning exceeds PromptGeneration.THINK_TOKENS or THINK_TIME,
+    raising ThinkBudgetExceeded (unless think_budget is False), or once the answer exceeds
+    ANSWER_TOKENS or ANSWER_TIME, in which case the answer is cut back to its last complete
+    sentence. It's also stopped once the answer holds ANSWER_SENTENCES complete sentences. For a
+    JSON object of several answers, answers gives their number: the answer budgets are multiplied
+    by it, and nothing is cut back or counted in sentences. Each streamed chunk is counted as a
+    token. The time to first token and tokens per second are added to attributes.
+    """
+    sentences = PromptGeneration.ANSWER_SENTENCES if answers is None else None
+    answer_tokens_budget = PromptGeneration.ANSWER_TOKENS and PromptGeneration.ANSWER_TOKENS * (answers or 1)
+    answer_time_budget = PromptGeneration.ANSWER_TIME and PromptGeneration.ANSWER_TIME * (answers or 1)
+    start = time.perf_counter()
+    first_token = answer_start = None
+    think_tokens = answer_tokens = 0
+    answer = ''
+    cutoff = complete = False
+    with get_session().post(url, headers=headers, json=data, verify=verify, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            thinking, content, done = parse_stream_line(line)
+            now = time.perf_counter()
+            if (thinking or content) and first_token is None:
+                first_token = now
+                tracing.record('llm first token', time.time() - (now - start), now - start)
+            reasoning = answer.lstrip().startswith('<think>') or not answer.strip()
+            reasoning = reasoning and '</think>' not in answer
+            answer += content
+
+            # Reasoning is either streamed separately or inline in <think> tags, counting the tags
+            if thinking or (content and reasoning and answer.lstrip().startswith('<think>')):
+                think_tokens += 1
+                if think_budget and (PromptGeneration.THINK_TOKENS is not None and think_tokens > PromptGeneration.THINK_TOKENS
+                                     or PromptGeneration.THINK_TIME is not None and now - first_token > PromptGeneration.THINK_TIME):
+                    raise ThinkBudgetExceeded(f"Reasoning exceeded its budget after {think_tokens} tokens")
+            elif content:
+                answer_tokens += 1
+                answer_start = answer_start or now
+                if (answer_tokens_budget is not None and answer_tokens > answer_tokens_budget
+                        or answer_time_budget is not None and now - answer_start > answer_time_budget):
+                    answer = answer[:-len(content)] # Keep only what arrived within the budget
+                    cutoff = True
+                    break
+
+                # Stop once the answer has as many sentences as needed, dropping the start of the next one
+                if sentences:
+                    think, separator, rest = answer.rpartition('</think>')
+                    ends = get_sentence_ends(rest)
+                    if len(ends) >= sentences:
+                        answer = think + separator + rest[:ends[sentences - 1]]
+                        complete = True
+                        break
+            if done:
+                break
+
+    # Record the time to first token and the rate tokens were generated at after it
+    end = time.perf_counter()
+    tokens = think_tokens + answer_tokens
+    first_token = first_token or end
+    seconds = end - first_token
+    attributes.update(first_token=first_token - start, tokens=tokens,
+                      tokens_per_s=tokens / seconds if seconds else None, cutoff=cutoff, complete=complete)
+    _stream_stats.add(first_token - start, tokens, seconds, cutoff)
+
+    if cutoff and answers is None:
+        think, separator, rest = answer.rpartition('</think>')
+        answer = think + separator + trim_to_sentence(rest)
+    return answer
+
+
+def disable_thinking(data: dict) -> dict:
+    """Return a copy of a request body asking the model not to reason before answering."""
+    if PromptGeneration.USE_OLLAMA:
+        return {**data, "think": False}
+    return {**data, "reasoning_effort": "low"}
+
+
+def strip_reasoning(response: str) -> str:
+    """Return a response without the reasoning of reasoning models, which ends with </think>."""
     think = "</think>"
-    think_index = result.find(think)
-    result = result if think_index == -1 else result[think_index + len(think):]
+    think_index = response.find(think)
+    return response if think_index == -1 else response[think_index + len(think):]
 
-    return result.replace("\n", " ").strip()
+
+def is_json_object(response: str) -> bool:
+    try:
+        return isinstance(json.loads(strip_reasoning(response)), dict)
+    except ValueError:
+        return False
+
+
+def get_response(text_prompt: str, schema: dict = None) -> str:
+    """
+    Return the model's response to a prompt, constrained to JSON matching schema if provided.
+    Responses cut off by a budget or that aren't the JSON object asked for aren't cached, so they're
+    requested again next time instead of being reused.
+    """
+    url, headers, data, verify = get_request(text_prompt, schema)
+
+    # Reuse the response to an identical earlier request if one is cached
+    cache = get_response_cache()
+    budgets = [PromptGeneration.THINK_TOKENS, PromptGeneration.THINK_TIME, PromptGeneration.ANSWER_TOKENS,
+               PromptGeneration.ANSWER_TIME, PromptGeneration.ANSWER_SENTENCES]
+    key = digest(PromptGeneration.USE_OLLAMA, data, budgets) if PromptGeneration.STREAM and any(budgets) else digest(PromptGeneration.USE_OLLAMA, data)
+    with tracing.span('llm request') as attributes:
+        result = cache.get(key)
+        if result is not None and schema is not None and not is_json_object(result):
+            result = None # Cached before responses like this were kept out of the cache
+        attributes['cached'] = result is not None
+        if result is None:
+            if PromptGeneration.STREAM:
+                # If the reasoning runs over budget, ask again with reasoning disabled, letting any
+                # reasoning the model still does run to its end as not every API can turn it off
+                data = {**data, "stream": True}
+                answers = len(schema['properties']) if schema is not None else None
+                try:
+                    result = stream_response(url, headers, data, verify, attributes, answers)
+                except ThinkBudgetExceeded:
+                    attributes['thinking_disabled'] = True
+                    result = stream_response(url, headers, disable_thinking(data), verify, attributes, answers, think_budget=False)
+            else:
+                response = get_session().post(url, headers=headers, json=data, verify=verify)
+                body = response.json()
+                result = body['response'] if PromptGeneration.USE_OLLAMA else body['choices'][0]['message']['content']
+            if not attributes.get('cutoff') and (schema is None or is_json_object(result)):
+                cache.put(key, result)
+
+    # Filter out CoT in reasoning models
+    return strip_reasoning(result).replace("\n", " ").strip()
 
 
 def unload_ollama_model():
@@ -80,27 +433,119 @@ def unload_ollama_model():
     subprocess.run(['ollama', 'stop', PromptGeneration.MODEL], check = True)
 
 
-def generate_scenes(filename: str = "scenes"):
+class SceneWriter:
+    """Append scenes to the scene file in order, holding back any that complete ahead of earlier ones."""
+
+    def __init__(self, path: str, scenes):
+        self.scenes = scenes
+        self.written = 0
+        self.file = open(path, 'w', encoding='utf-8')
+        self.flush()
+
+    def put(self, index: int, scene: str):
+        self.scenes[index] = scene
+        self.flush()
+
+    def flush(self):
+        while self.written < len(self.scenes) and self.scenes[self.written] is not None:
+            if self.written:
+                self.file.write('\n\n')
+            self.file.write(self.scenes[self.written])
+            self.written += 1
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_scenes(path: str):
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as file:
+        scenes = file.read().split('\n\n')
+    return [scene.strip() for scene in scenes if scene.strip()]
+
+
+def generate_scenes(filename: str = "scenes", on_plan=None, on_scene=None):
+    """
+    Write a description of the imagery of each image segment to the scene file.
+
+    on_plan, if provided, is called with the list of scenes before any request is sent, holding the
+    reused scenes and None for the ones still to be generated. on_scene is then called with the
+    index and text of each generated scene as it completes.
+    """
     lines = get_image_segments()
 
-    with open('scene_template.txt', 'r', encoding='utf-8') as file:
+    # Count the cache hits and streamed responses of this story alone, as a batch runs several
+    get_response_cache().reset_stats()
+    _stream_stats.reset()
+
+    # Include the whole story, or a window of neighbouring segments after a summary of the story
+    window = PromptGeneration.CONTEXT_WINDOW
+    template_path = 'scene_template.txt' if window is None else 'scene_template_window.txt'
+    with open(template_path, 'r', encoding='utf-8') as file:
         scene_template = file.read()
+    batch_template_path = 'scene_batch_template.txt' if window is None else 'scene_batch_template_window.txt'
+    with open(batch_template_path, 'r', encoding='utf-8') as file:
+        batch_template = file.read()
+    summary = get_story_summary(lines) if window is not None and PromptGeneration.SUMMARIZE else ''
+
+    # Reuse descriptions for segments whose nearby text, template and model haven't changed
+    path = os.path.join(settings.SOURCE_DIRECTORY, f'{filename}.txt')
+    text_prompts = [get_text_prompt(index, scene_template, lines, window, summary) for index in range(len(lines))]
+    keys = [get_scene_key(index, scene_template, lines, window) for index in range(len(lines))]
+    previous = read_scenes(path)
+    manifest = Manifest('scenes')
+    sources = manifest.plan(keys, lambda index: index < len(previous))
+    if not PromptGeneration.CACHE_RESPONSES:
+        sources = [None] * len(keys)
+    scenes = [previous[source] if source is not None else None for source in sources]
+    manifest.reset(keys, sources)
+    pending = [index for index, scene in enumerate(scenes) if scene is None]
+    if on_plan:
+        on_plan(list(scenes))
+    if not pending:
+        if len(previous) != len(scenes) or any(source != index for index, source in enumerate(sources)):
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('\n\n'.join(scenes))
+        return 0
+
+    # Describe up to PromptGeneration.BATCH_SIZE consecutive pending segments per request
+    def get_prompt(indices):
+        if len(indices) == 1:
+            return text_prompts[indices[0]]
+        return get_batch_prompt(indices, batch_template, lines, window, summary)
 
-    prompts = ''
-    path = os.path.join(SOURCE_DIRECTORY, f'{filename}.txt')
-    for index, _ in enumerate(lines):
-        print_progress_bar(index, len(lines), 'scenes generated')
-        text_prompt = get_text_prompt(index, scene_template, lines)
-        scene_description = get_response(text_prompt)
-        prompts += '\n\n' + scene_description
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(prompts)
-    print_progress_bar(len(lines), len(lines), 'scenes generated\n')
-
-    # Write the final sentences to a new file, each on a new line
-    prompts = prompts[2:] # Remove leading newline
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(prompts)
+    # Keep up to PromptGeneration.CONCURRENCY requests in flight, writing results in order
+    print_progress_bar(0, len(pending), 'scenes generated')
+    executor = ThreadPoolExecutor(max_workers=max(PromptGeneration.CONCURRENCY, 1))
+    try:
+        with SceneWriter(path, scenes) as writer:
+            batches = get_runs(pending, max(PromptGeneration.BATCH_SIZE, 1))
+            futures = [executor.submit(get_scene_batch, batch, get_prompt) for batch in batches]
+            completed = 0
+            for future in as_completed(futures):
+                for index, scene in sorted(future.result().items()):
+                    writer.put(index, scene)
+                    manifest.set(index, keys[index])
+                    if on_scene:
+                        on_scene(index, scene)
+                manifest.save()
+                completed += len(future.result())
+                print_progress_bar(completed, len(pending), 'scenes generated')
+    finally:
+        executor.shutdown(cancel_futures=True)
+    print_progress_bar(len(pending), len(pending), 'scenes generated\n')
+    print(f"Response cache: {get_response_cache().stats()}")
+    if PromptGeneration.STREAM:
+        print(f"Streamed responses: {_stream_stats}")
+    return len(pending)
 
 
 if __name__ == "__main__":
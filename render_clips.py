@@ -1,10 +1,16 @@
 import os
-import textwrap
+import tempfile
+import tracing
 from typing import List, Tuple
-from moviepy import ImageClip, AudioFileClip, TextClip, CompositeVideoClip, VideoClip, ImageSequenceClip, concatenate_videoclips
+from moviepy import ImageClip, AudioFileClip, CompositeVideoClip, VideoClip, ImageSequenceClip, concatenate_videoclips
 from moviepy.video.fx.CrossFadeIn import CrossFadeIn
-from settings import VideoGeneration, SOURCE_DIRECTORY
-from utility import parse_lines, get_audio_clips
+from audio_assembler import assemble_audio
+from ffmpeg_renderer import render_ffmpeg
+from frame_compositor import get_image_spans, get_image_path, render_numpy
+import settings
+from settings import VideoGeneration
+from subtitle_cache import get_subtitle_bitmap, get_subtitle_height
+from utility import parse_lines, get_audio_durations, get_line_audio
 
 
 def generate_image_clip(rows: List[Tuple[float, str, str]]) -> VideoClip:
@@ -15,41 +21,30 @@ def generate_image_clip(rows: List[Tuple[float, str, str]]) -> VideoClip:
     def pan_position(length):
         return lambda t: ('center', (-t / length) * (VideoGeneration.HEIGHT * VideoGeneration.SUBTITLE_RATIO))
 
-    for i in range(len(rows)):
-        duration, image_name, _ = rows[i]
+    for i, (start, duration, image_name) in enumerate(get_image_spans(rows)):
 
-        if image_name:
+        # Total duration, accounting for crossfade
+        fade_duration = duration + VideoGeneration.CROSSFADE_DURATION
 
-            j = i + 1
-            while j < len(rows) and not rows[j][1]:
-                duration += rows[j][0]
-                j += 1
+        # Create an image clip
+        image_clip: VideoClip = ImageClip(get_image_path(image_name))
+        image_clip = image_clip.with_duration(fade_duration)
+        image_clip = image_clip.with_position(('center', 'center'))
+        image_clip = image_clip.resized(height=VideoGeneration.HEIGHT)
 
-            # Total duration, accounting for crossfade
-            fade_duration = duration + VideoGeneration.CROSSFADE_DURATION
+        # Apply pan effect
+        image_clip = image_clip.with_position(pan_position(length=fade_duration))
+        image_clip = image_clip.with_start(start)
 
-            # Create an image clip
-            image_path = f'{SOURCE_DIRECTORY}/images/{image_name}'
-            if not image_path.endswith(".png"):
-                image_path += ".png"
-            image_clip: VideoClip = ImageClip(image_path)
-            image_clip = image_clip.with_duration(fade_duration)
-            image_clip = image_clip.with_position(('center', 'center'))
-            image_clip = image_clip.resized(height=VideoGeneration.HEIGHT)
+        # Apply cross fade
+        if i > 0:
+            image_clip = image_clip.with_effects([CrossFadeIn(VideoGeneration.CROSSFADE_DURATION)])
 
-            # Apply pan effect
-            image_clip = image_clip.with_position(pan_position(length=fade_duration))
-            image_clip = image_clip.with_start(total_duration)
+        # Add the image clip to the list
+        image_clips.append(image_clip)
 
-            # Apply cross fade
-            if i > 0:
-                image_clip = image_clip.with_effects([CrossFadeIn(VideoGeneration.CROSSFADE_DURATION)])
-
-            # Add the image clip to the list
-            image_clips.append(image_clip)
-
-            # Update the total duration
-            total_duration += duration
+        # Update the total duration
+        total_duration = start + duration
 
     # Concatenate all image clips with crossfade transition
     final_image_clip = CompositeVideoClip(image_clips)
@@ -58,28 +53,16 @@ def generate_image_clip(rows: List[Tuple[float, str, str]]) -> VideoClip:
     return final_image_clip
 
 
-def generate_subtitle_clip(rows: List[Tuple[float, str, str]], audio_clips: List[AudioFileClip]) -> VideoClip:
+def generate_subtitle_clip(rows: List[Tuple[float, str, str]]) -> VideoClip:
     # Initialize a list to hold all subtitle clips
     subtitle_clips = []
 
-    height = int(VideoGeneration.HEIGHT * VideoGeneration.SUBTITLE_RATIO)
+    height = get_subtitle_height()
     for index, (duration, _, text) in enumerate(rows):
-        # Create a text clip for the subtitle
-        text = textwrap.fill(text, VideoGeneration.CHARACTERS_PER_LINE)
-        subtitle_clip = TextClip(
-            text=text,
-            font=VideoGeneration.FONT,
-            font_size=VideoGeneration.FONT_SIZE,
-            color=VideoGeneration.TEXT_COLOR,
-            bg_color=VideoGeneration.BACKGROUND_COLOR,
-            size=(VideoGeneration.WIDTH, height)
-        )
+        # Create a static clip from the cached subtitle bitmap
+        subtitle_clip = ImageClip(get_subtitle_bitmap(text))
         subtitle_clip = subtitle_clip.with_duration(duration)
 
-        # Add the audio clip if one exists
-        if audio_clips[index] is not None:
-            subtitle_clip = subtitle_clip.with_audio(audio_clips[index])
-
         # Add the subtitle clip to the list
         subtitle_clips.append(subtitle_clip)
 
@@ -95,23 +78,38 @@ def video_from_sequence(directory) -> VideoClip:
     return ImageSequenceClip(frames, fps=VideoGeneration.FRAME_RATE)
 
 
-def render_clips(filename: str = 'video'):
-
-    # Generate image and subtitle clips
+def load_timeline():
+    """Return the script lines, with the duration of their audio where they have any, and their audio."""
     lines = parse_lines()
-    print("Lines parsed...")
+    audio_files = get_line_audio(len(lines))
+    for index, duration in enumerate(get_audio_durations(len(lines))):
+        if duration:
+            lines[index] = lines[index]._replace(duration=duration)
+    return lines, audio_files
 
-    # Add clip audio files if they exist
-    audio_clips = get_audio_clips(len(lines))
-    for index, (_, image, line) in enumerate(lines):
-        if audio_clips[index]:
-            lines[index] = (audio_clips[index].duration, image, line)
-    print("Audio files processed...")
+
+def render_clips(filename: str = 'video'):
+
+    # Generate image and subtitle clips, with the duration of their audio files if they exist
+    lines, audio_files = load_timeline()
+    print("Lines and audio files processed...")
+
+    if VideoGeneration.ENGINE in ['numpy', 'ffmpeg']:
+        if VideoGeneration.GENERATE_FRAMES:
+            frames_dir = os.path.join(settings.SOURCE_DIRECTORY, 'frames')
+            os.makedirs(frames_dir, exist_ok=True)
+            output_path = os.path.join(frames_dir, 'frame%06d.png')
+        else:
+            output_path = os.path.join(settings.SOURCE_DIRECTORY, f'{filename}.mp4')
+        render = render_numpy if VideoGeneration.ENGINE == 'numpy' else render_ffmpeg
+        render(lines, audio_files, output_path)
+        print("Video rendered...")
+        return
 
     image_clip = generate_image_clip(lines)
     print("Image clip generated...")
     
-    subtitle_clip = generate_subtitle_clip(lines, audio_clips)
+    subtitle_clip = generate_subtitle_clip(lines)
     print("Subtitle clip generated...")
 
     # Calculate the total duration of all lines
@@ -121,29 +119,30 @@ def render_clips(filename: str = 'video'):
     final_video = CompositeVideoClip([image_clip, subtitle_clip], size=(VideoGeneration.WIDTH, VideoGeneration.HEIGHT))
     final_video = final_video.with_duration(total_duration)
 
-    # Add the audio if available, truncated to the total length
-    audio_path = os.path.join(SOURCE_DIRECTORY, 'audio.mp3')
-    if os.path.isfile(audio_path):
-        final_audio = AudioFileClip(audio_path).subclip(0, total_duration)
-        mixed_audio = CompositeVideoClip([final_video.audio, final_audio])
-        final_video = final_video.with_audio(mixed_audio)
-
     # Write the final video file or frames
     if VideoGeneration.GENERATE_FRAMES:
-        frames_dir = os.path.join(SOURCE_DIRECTORY, 'frames')
+        frames_dir = os.path.join(settings.SOURCE_DIRECTORY, 'frames')
         if not os.path.exists(frames_dir):
             os.makedirs(frames_dir)
         frames_path = os.path.join(frames_dir, 'frame%06d.png')
         final_video.write_images_sequence(frames_path, fps=VideoGeneration.FRAME_RATE)
     else:
-        video_path = os.path.join(SOURCE_DIRECTORY, f'{filename}.mp4')
-        final_video.write_videofile(
-            video_path,
-            fps=VideoGeneration.FRAME_RATE,
-            codec=VideoGeneration.CODEC,
-            audio_codec='aac',
-            threads=32
-        )
+        # Add the narration and background audio as one assembled track
+        with tempfile.TemporaryDirectory() as temp_dir:
+            audio_path = os.path.join(temp_dir, 'audio.wav')
+            assemble_audio(lines, audio_files, audio_path)
+            audio_clip = AudioFileClip(audio_path)
+            final_video = final_video.with_audio(audio_clip)
+            video_path = os.path.join(settings.SOURCE_DIRECTORY, f'{filename}.mp4')
+            with tracing.span('encode moviepy'):
+                final_video.write_videofile(
+                    video_path,
+                    fps=VideoGeneration.FRAME_RATE,
+                    codec=VideoGeneration.CODEC,
+                    audio_codec='aac',
+                    threads=VideoGeneration.THREADS
+                )
+            audio_clip.close()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
 import os
-from settings import ScriptAnnotation, SOURCE_DIRECTORY
-from utility import approximate_duration, get_audio_clips
+import numpy as np
+import settings
+from settings import ScriptAnnotation
+from utility import approximate_duration, get_audio_durations, write_script
 
 
 def divide_into_segments(durations, target):
@@ -32,23 +34,32 @@ def divide_into_segments(durations, target):
     prefix = [0] * (n + 1)
     for i in range(n):
         prefix[i + 1] = prefix[i] + durations[i]
+    prefix = np.array(prefix, dtype=np.float64)
+
+    # A segment lasting at least 2 * target + max(durations) is never optimal: splitting it where its
+    # first part reaches the target leaves two parts of at least the target each, which costs less.
+    # Only segment starts within that bound of each end need to be considered.
+    if target > 0:
+        bound = 2 * target + max(durations)
+        lows = np.searchsorted(prefix, prefix - bound * (1 + 1e-9), side='left')
+    else:
+        lows = np.zeros(n + 1, dtype=int)
 
     # dp[i] will hold the minimum total cost for segmenting durations[0:i]
-    dp = [float('inf')] * (n + 1)
+    dp = np.full(n + 1, np.inf)
     dp[0] = 0  # no sentences -> no cost
 
     # prev[i] will store the index where the last segment started for an optimal segmentation of durations[0:i]
     prev = [0] * (n + 1)
 
-    # Fill in dp and prev using dynamic programming.
+    # Fill in dp and prev using dynamic programming, trying every start j for the final segment
+    # ending at i-1 at once. argmin picks the earliest of equal costs, as the scalar loop did.
     for i in range(1, n + 1):
-        # Try every possible start j for the final segment ending at i-1.
-        for j in range(i):
-            seg_duration = prefix[i] - prefix[j]
-            cost = abs(seg_duration - target)
-            if dp[j] + cost < dp[i]:
-                dp[i] = dp[j] + cost
-                prev[i] = j
+        low = min(lows[i], i - 1)
+        costs = dp[low:i] + np.abs(prefix[i] - prefix[low:i] - target)
+        best = int(np.argmin(costs))
+        dp[i] = costs[best]
+        prev[i] = low + best
 
     # Reconstruct the segmentation to obtain the starting indices.
     start_indices = []
@@ -65,7 +76,7 @@ def divide_into_segments(durations, target):
 def annotate_script(filename: str = 'script'):
 
     # Parse and split the caption file
-    story_path = os.path.join(SOURCE_DIRECTORY, 'captions.txt')
+    story_path = os.path.join(settings.SOURCE_DIRECTORY, 'captions.txt')
     with open(story_path, 'r', encoding='utf-8') as f:
         text = f.read()
     captions = text.split("\n")
@@ -73,9 +84,9 @@ def annotate_script(filename: str = 'script'):
 
     # Procedurally assigned image markers
     total_images = 0
-    audio_clips = get_audio_clips(len(captions))
-    durations = [audio_clips[i].duration if audio_clips[i] else approximate_duration(line) for i, line in enumerate(captions)]
-    segment_indices = divide_into_segments(durations, ScriptAnnotation.TARGET_DURATION)
+    audio_durations = get_audio_durations(len(captions))
+    durations = [audio_durations[i] or approximate_duration(line) for i, line in enumerate(captions)]
+    segment_indices = set(divide_into_segments(durations, ScriptAnnotation.TARGET_DURATION))
     for index in range(len(captions)):
         formatted = captions[index]
         if index in segment_indices:
@@ -83,11 +94,8 @@ def annotate_script(filename: str = 'script'):
             total_images += 1
         captions[index] = formatted
 
-    # Write the sentences to a new file, each on a new line
-    file_path = os.path.join(SOURCE_DIRECTORY, f'{filename}.txt')
-    with open(file_path, 'w', encoding='utf-8') as f:
-        for line in captions:
-            f.write(line + '\n\n')
+    # Write the sentences to a new file, each on a new line, along with their parsed form
+    write_script(filename, captions)
 
 
 if __name__ == "__main__":
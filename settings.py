@@ -17,15 +17,28 @@ class VideoGeneration:
     GENERATE_FRAMES = False # Whether to generate a series of frames, or if false, encode the video directly
     FONT_SIZE = 32 # Size of the captioning text
     FONT = 'Arial' # Font of the captioning text
+    SUBTITLE_CACHE = '.cache/subtitles' # Directory that rasterized subtitles are cached in, None to only cache them in memory
+    SUBTITLE_CACHE_SIZE = 256 # Number of rasterized subtitles kept in memory
     CODEC = 'libx264' # Codec to encode the final video file with
+    THREADS = 32 # Number of threads used by ffmpeg when encoding with moviepy
+    RENDER_WORKERS = 1 # Number of processes rendering chunks of the video in parallel with the numpy or ffmpeg engines
+    CHUNK_IMAGES = 10 # Number of images in each chunk rendered by a worker process, which bounds the memory of each ffmpeg process
+    ENGINE = 'moviepy' # Render engine, 'moviepy' to composite clips with moviepy, 'numpy' to composite frames with NumPy and pipe them into ffmpeg, or 'ffmpeg' to render entirely within an ffmpeg filtergraph
 
 # Settings used when generating images through the ComfyUI API
 class ImageGeneration:
     HOST = '127.0.0.1' # Host address that the API is accessible from
     PORT = 8000 # Port that the API is available through
+    SERVERS = None # List of 'host:port' ComfyUI servers to spread images across, None to only use HOST and PORT
+    RETRIES = 2 # Number of times a failed image is retried, on another server if one is available
+    HEALTH_INTERVAL = 30 # Seconds between health checks of the ComfyUI servers
     WORKFLOW = 'klein9b.json' # Workflow JSON filename relative to workflows/, or an absolute path
     WIDTH = 1280 # Width in pixels of each generated image
     HEIGHT = 720 # Height in pixels of each generated image
+    QUEUE_DEPTH = 2 # Number of prompts kept queued on the ComfyUI server at once
+    DOWNLOAD_WORKERS = 2 # Number of threads that download and save finished images
+    TRANSFER = 'history' # How images are fetched: 'history' downloads each image, 'stream' streams it to disk in chunks, 'websocket' receives it over the WebSocket without saving it on the server
+    SEED = None # Base seed for reproducible images, None to randomize the seed of every image
 
 # Settings used to generate prompts through a compatible LLM API
 class PromptGeneration:
@@ -34,6 +47,22 @@ class PromptGeneration:
     USE_OLLAMA = True # Whether to use the native Ollama API instead of the OpenAI chat completions API
     MODEL = 'gemma3:27b' # Name of the model to generate the prompts with
     API_KEY = None
+    CONTEXT_LENGTH = 16384 # Context window size in tokens requested from Ollama
+    CONTEXT_WINDOW = None # Number of neighbouring segments to include on each side of the described segment, None to include the whole story
+    KEY_WINDOW = 2 # Number of neighbouring segments on each side whose edits regenerate a segment's description, at most CONTEXT_WINDOW
+    SUMMARIZE = True # Whether to include a summary of the whole story in each prompt when CONTEXT_WINDOW is set
+    SUMMARY_CHUNK = 20 # Number of segments added to the rolling story summary per request
+    CACHE_RESPONSES = True # Whether to reuse cached responses to identical requests, pass --fresh to sample new responses
+    CACHE_PATH = '.cache/responses.sqlite' # Location of the persistent response cache
+    CACHE_SIZE = 256 # Maximum size of the cached responses in megabytes
+    CONCURRENCY = 1 # Number of scene requests to keep in flight at once, increase for servers that handle parallel requests
+    STREAM = True # Whether to stream responses, which enforces the budgets below and records the time to first token and tokens per second
+    THINK_TOKENS = None # Maximum reasoning tokens before a response is requested again with reasoning disabled (or reduced, where the API can't disable it), None for no limit
+    THINK_TIME = None # Maximum seconds of reasoning before a response is requested again with reasoning disabled, None for no limit
+    ANSWER_TOKENS = None # Maximum tokens of an answer before it's stopped and cut back to its last complete sentence, None for no limit
+    ANSWER_TIME = None # Maximum seconds of an answer before it's stopped and cut back to its last complete sentence, None for no limit
+    ANSWER_SENTENCES = None # Number of complete sentences after which an answer is stopped, None to let the model finish
+    BATCH_SIZE = 1 # Number of consecutive scenes to request at once as a JSON object, sending the story context once per batch instead of once per scene
 
 # Settings used when adding image annotations to the script
 class ScriptAnnotation:
@@ -45,6 +74,8 @@ class TTSGeneration:
     VOICE = 'af_heart' # Kokoro voice model, None to skip TTS
     SPEED = 1 # Speed multiplier for the generated audio
     SAMPLE_RATE = 24000 # Sample rate to encode the audio file with
+    WORKERS = 1 # Number of processes generating audio in parallel, each loading its own copy of the model and sharing the CPU cores
+    PACKED = False # Whether to store the audio of all lines in one packed file (audio/packed.pcm) instead of a WAV file per line
 
 # Settings used to procedurally split a provided story file into a segmented script
 class CaptionSplitter:
@@ -54,20 +85,38 @@ class CaptionSplitter:
 class Pipeline:
     DYNAMICALLY_UNLOAD_OLLAMA = True # Whether to unload the LLM from memory after use, will have no effect if not using Ollama locally
     DYNAMICALLY_UNLOAD_COMFYUI = True # Whether to unload the image diffusion model from memory after use
+    STREAMING = False # Whether to queue each scene's image as soon as the scene is written and render video chunks as soon as their images are saved, instead of running each step to completion
+    SHARED_GPU = True # Whether the LLM and ComfyUI share a GPU, in which case streaming still waits for every scene (and unloads the LLM) before generating images
+    TRACE = False # Whether to record timing spans of each step and request to .cache/trace.jsonl and print a summary at the end
+    PROFILE = [] # Names of steps to profile with cProfile, e.g. ['video rendering'], saving the stats to .cache/profile-<step>.prof
+    TRACE_MEMORY = [] # Names of steps to trace memory allocations of with tracemalloc, printing the largest at the end of the step
 
 
 
 
 # The first argument will override STORY_NAME if provided when running
 # Pass --clean to delete existing generated files before each step
+# Pass --fresh to ignore cached LLM responses
+# Pass --trace to record and summarize the time spent in each step
+# Pass several story names, or --jobs=<file> listing one per line, to run them as one batch, see run_batch in generate_video.py
 def _resolve_path(value, default_dir):
     """Resolve a path relative to default_dir, unless it's already absolute."""
     if os.path.isabs(value):
         return value
     return os.path.join(default_dir, value)
 
+def set_story(name):
+    """Point the pipeline at another story, resolved like the first argument."""
+    global SOURCE_DIRECTORY
+    SOURCE_DIRECTORY = _resolve_path(name, 'content')
+
 args = [a for a in sys.argv[1:] if not a.startswith('-')]
-story_name = args[0] if args else STORY_NAME
-SOURCE_DIRECTORY = _resolve_path(story_name, 'content')
+JOBS = next((a.partition('=')[2] for a in sys.argv[1:] if a.startswith('--jobs=')), None)
+STORIES = args or ([] if JOBS else [STORY_NAME])
+set_story(STORIES[0] if STORIES else STORY_NAME)
 ImageGeneration.WORKFLOW = _resolve_path(ImageGeneration.WORKFLOW, 'workflows')
-CLEAN = '--clean' in sys.argv
\ No newline at end of file
+CLEAN = '--clean' in sys.argv
+if '--fresh' in sys.argv:
+    PromptGeneration.CACHE_RESPONSES = False
+if '--trace' in sys.argv:
+    Pipeline.TRACE = True
@@ -0,0 +1,77 @@
+from frame_compositor import ChunkRenderer
+from image_generator import ImageQueue, get_prompts, unload_diffusion_model
+from prompt_generator import generate_scenes, unload_ollama_model
+from render_clips import load_timeline
+from settings import VideoGeneration, Pipeline
+
+
+def generate_streaming(unload: bool = True):
+    """
+    Generate the scenes, their images and the video chunks as one producer/consumer pipeline.
+
+    Each scene is queued for its image as soon as it's written, and each chunk of the video is
+    rendered into the chunk cache as soon as the images drawn in it are saved, so the video
+    rendering step only has to join the chunks. With the LLM and ComfyUI on separate machines,
+    the scenes and images then take about as long as the slower of the two instead of their sum.
+
+    With Pipeline.SHARED_GPU, the images are only started once every scene is written and the LLM
+    is unloaded (with Pipeline.DYNAMICALLY_UNLOAD_OLLAMA), as both models may not fit at once.
+    Chunks are only rendered ahead with the 'numpy' engine, as the others render the video whole.
+    With unload set to False, neither model is unloaded, leaving it to the caller (see unload_models).
+
+    Returns the number of scenes and images generated.
+    """
+    # Start the render processes before any threads
+    renderer = None
+    if VideoGeneration.ENGINE == 'numpy' and not VideoGeneration.GENERATE_FRAMES:
+        renderer = ChunkRenderer(load_timeline()[0])
+
+    images = None
+
+    def on_plan(scenes):
+        nonlocal images
+        on_image = (lambda index: renderer.image_ready(f"{index}.png")) if renderer else None
+        images = ImageQueue(scenes, on_image=on_image)
+        if renderer:
+            renderer.start([f"{index}.png" for index in images.pending])
+        if not Pipeline.SHARED_GPU:
+            for index in images.pending:
+                if scenes[index] is not None:
+                    images.put(index, scenes[index])
+
+    def on_scene(index, scene):
+        if not Pipeline.SHARED_GPU:
+            images.put(index, scene.strip())
+
+    try:
+        scene_count = generate_scenes(on_plan=on_plan, on_scene=on_scene)
+        if unload and scene_count and Pipeline.DYNAMICALLY_UNLOAD_OLLAMA:
+            unload_ollama_model()
+        if Pipeline.SHARED_GPU:
+            prompts = get_prompts()
+            for index in images.pending:
+                images.put(index, prompts[index])
+        image_count = images.finish()
+        if unload and image_count and Pipeline.DYNAMICALLY_UNLOAD_COMFYUI:
+            unload_diffusion_model()
+        if renderer:
+            chunk_count = renderer.finish()
+            print(f"{chunk_count} video chunks rendered")
+    finally:
+        if images:
+            images.close()
+        if renderer:
+            renderer.executor.shutdown(cancel_futures=True)
+    return scene_count + image_count
+
+
+def unload_models():
+    """Unload the LLM and the diffusion model, as set by the Pipeline.DYNAMICALLY_UNLOAD_* settings."""
+    if Pipeline.DYNAMICALLY_UNLOAD_OLLAMA:
+        unload_ollama_model()
+    if Pipeline.DYNAMICALLY_UNLOAD_COMFYUI:
+        unload_diffusion_model()
+
+
+if __name__ == "__main__":
+    generate_streaming()
@@ -0,0 +1,72 @@
+import os
+import textwrap
+from collections import OrderedDict
+import numpy as np
+from moviepy import TextClip
+from cache import digest
+from settings import VideoGeneration
+
+
+_bitmaps = OrderedDict()
+
+
+def get_subtitle_height() -> int:
+    return int(VideoGeneration.HEIGHT * VideoGeneration.SUBTITLE_RATIO)
+
+
+def rasterize_subtitle(text: str, size) -> np.ndarray:
+    """Rasterize a subtitle band with the given wrapped text as an RGBA array."""
+    subtitle_clip = TextClip(
+        text=text,
+        font=VideoGeneration.FONT,
+        font_size=VideoGeneration.FONT_SIZE,
+        color=VideoGeneration.TEXT_COLOR,
+        bg_color=VideoGeneration.BACKGROUND_COLOR,
+        size=size
+    )
+    bitmap = np.empty((size[1], size[0], 4), dtype=np.uint8)
+    bitmap[:, :, :3] = subtitle_clip.get_frame(0)[:, :, :3]
+    bitmap[:, :, 3] = 255 if subtitle_clip.mask is None else np.round(subtitle_clip.mask.get_frame(0) * 255)
+    return bitmap
+
+
+def get_subtitle_bitmap(text: str) -> np.ndarray:
+    """
+    Return the subtitle band for the given text as a read-only RGBA array.
+
+    Bitmaps are cached per unique text, font, size, colors and box, in memory for the last
+    VideoGeneration.SUBTITLE_CACHE_SIZE bitmaps used and on disk in VideoGeneration.SUBTITLE_CACHE,
+    so repeated captions and reruns never rasterize the same subtitle twice.
+    """
+    text = textwrap.fill(text, VideoGeneration.CHARACTERS_PER_LINE)
+    size = (VideoGeneration.WIDTH, get_subtitle_height())
+    key = digest(text, VideoGeneration.FONT, VideoGeneration.FONT_SIZE, VideoGeneration.TEXT_COLOR,
+                 VideoGeneration.BACKGROUND_COLOR, size)
+
+    # In-memory layer
+    if key in _bitmaps:
+        _bitmaps.move_to_end(key)
+        return _bitmaps[key]
+
+    # On-disk layer
+    path = os.path.join(VideoGeneration.SUBTITLE_CACHE, f'{key}.npy') if VideoGeneration.SUBTITLE_CACHE else None
+    bitmap = None
+    if path and os.path.isfile(path):
+        try:
+            bitmap = np.load(path)
+        except (OSError, ValueError):
+            bitmap = None
+    if bitmap is None:
+        bitmap = rasterize_subtitle(text, size)
+        if path:
+            os.makedirs(VideoGeneration.SUBTITLE_CACHE, exist_ok=True)
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as f:
+                np.save(f, bitmap)
+            os.replace(temp_path, path)
+
+    bitmap.setflags(write=False)
+    _bitmaps[key] = bitmap
+    while len(_bitmaps) > VideoGeneration.SUBTITLE_CACHE_SIZE:
+        _bitmaps.popitem(last=False)
+    return bitmap
@@ -0,0 +1,29 @@
+import json
+import numpy as np
+from audio_store import PackedAudio
+
+
+def test_appended_lines_survive_an_interruption(tmp_path):
+    store = PackedAudio(str(tmp_path))
+    store.append(0, np.full(100, 0.5))
+    store.append(1, np.full(50, -0.5))
+    index_size = (tmp_path / 'packed.json').stat().st_size
+
+    # Stop without closing, cutting off the last log record
+    store.pcm_file.flush()
+    with open(tmp_path / 'packed.log', 'a', encoding='utf-8') as f:
+        f.write('["2", 150')
+    assert (tmp_path / 'packed.json').stat().st_size == index_size
+
+    resumed = PackedAudio(str(tmp_path))
+    assert 0 in resumed and 1 in resumed and 2 not in resumed
+    assert resumed.end == 150
+    resumed.append(2, np.full(10, 0.25))
+    resumed.close()
+
+    reopened = PackedAudio(str(tmp_path))
+    assert not (tmp_path / 'packed.log').exists()
+    assert json.loads((tmp_path / 'packed.json').read_text())['end'] == 160
+    assert [reopened.entries[key] for key in ['0', '1', '2']] == [[0, 100], [100, 50], [150, 10]]
+    assert reopened.get(1)[0][0, 0] == -16384
+    assert reopened.get(2)[0].shape == (10, 1)
@@ -0,0 +1,21 @@
+import settings
+from cache import Manifest
+
+
+def test_manifest_keeps_recorded_items_after_an_interruption(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'SOURCE_DIRECTORY', str(tmp_path))
+    manifest = Manifest('tts')
+    manifest.reset(['a', 'b', 'c'], [0, None, None])
+    manifest.record(1, 'b')
+
+    # Stop without saving, cutting off the last log record
+    with open(tmp_path / '.cache' / 'tts.log', 'a', encoding='utf-8') as f:
+        f.write('[2, "c')
+    resumed = Manifest('tts')
+    assert resumed.entries == {'0': 'a', '1': 'b'}
+    assert resumed.plan(['a', 'b', 'c'], lambda index: True) == [0, 1, None]
+
+    resumed.record(2, 'c')
+    resumed.save()
+    assert not (tmp_path / '.cache' / 'tts.log').exists()
+    assert Manifest('tts').entries == {'0': 'a', '1': 'b', '2': 'c'}
@@ -0,0 +1,30 @@
+import threading
+import pytest
+from benchmarks.stub_servers import ComfyServer
+from comfy_client import ComfyClient
+
+
+@pytest.fixture
+def comfy_server():
+    server = ComfyServer(image_latency=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('transfer', ['history', 'websocket'])
+def test_repeated_prompt_still_saves_its_image(tmp_path, comfy_server, transfer):
+    save_class = 'SaveImageWebsocket' if transfer == 'websocket' else 'SaveImage'
+    workflow = {
+        '1': {'class_type': 'CLIPTextEncode', 'inputs': {'text': 'A quiet harbor.'}},
+        '2': {'class_type': save_class, 'inputs': {'images': ['1', 0]}},
+    }
+    client = ComfyClient('127.0.0.1', comfy_server.server_address[1], transfer=transfer, websocket_outputs=['2'])
+    try:
+        for name in ['first.png', 'second.png']:
+            path = str(tmp_path / name)
+            assert client.submit(workflow, path).result(timeout=10) == path
+    finally:
+        client.close()
+    assert (tmp_path / 'first.png').read_bytes() == (tmp_path / 'second.png').read_bytes()
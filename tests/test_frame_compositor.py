@@ -0,0 +1,33 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+import frame_compositor
+import ffmpeg_renderer
+import settings
+from settings import VideoGeneration, Pipeline
+from subtitle_cache import get_subtitle_height
+
+
+@pytest.mark.parametrize('render', [frame_compositor.render_numpy, ffmpeg_renderer.render_ffmpeg])
+@pytest.mark.parametrize('story', ['story', "the writer's story"])
+def test_chunks_of_a_relative_story_directory_are_joined(tmp_path, monkeypatch, story, render):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, 'SOURCE_DIRECTORY', os.path.join('content', story))
+    for name, value in dict(WIDTH=64, HEIGHT=36, FRAME_RATE=10, CROSSFADE_DURATION=0.2, CHUNK_IMAGES=1,
+                            RENDER_WORKERS=2, GENERATE_FRAMES=False, SUBTITLE_CACHE=None).items():
+        monkeypatch.setattr(VideoGeneration, name, value)
+    monkeypatch.setattr(Pipeline, 'STREAMING', False)
+    band = np.full((get_subtitle_height(), VideoGeneration.WIDTH, 4), 255, dtype=np.uint8)
+    monkeypatch.setattr(frame_compositor, 'get_subtitle_bitmap', lambda text: band)
+
+    os.makedirs(os.path.join('content', story, 'images'))
+    for index, color in enumerate(['red', 'green', 'blue']):
+        Image.new('RGB', (64, 64), color).save(os.path.join('content', story, 'images', f'{index}.png'))
+    rows = [(1.0, str(index), f'Line {index}.') for index in range(3)]
+
+    output_path = os.path.join('content', story, 'video.mp4')
+    render(rows, [None] * 3, output_path)
+    assert os.path.getsize(output_path) > 0
+    if render is frame_compositor.render_numpy:
+        assert len(os.listdir(frame_compositor.get_chunk_directory())) == 3
@@ -0,0 +1,42 @@
+import os
+import generate_video
+import streaming
+from settings import Pipeline
+
+
+def test_streaming_batch_unloads_models_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(Pipeline, 'STREAMING', True)
+    monkeypatch.setattr(Pipeline, 'SHARED_GPU', False)
+    monkeypatch.setattr(Pipeline, 'DYNAMICALLY_UNLOAD_OLLAMA', True)
+    monkeypatch.setattr(Pipeline, 'DYNAMICALLY_UNLOAD_COMFYUI', True)
+    monkeypatch.setattr(generate_video, 'CLEAN', False)
+    for name in ['split_captions', 'generate_tts', 'annotate_script', 'render_clips']:
+        monkeypatch.setattr(generate_video, name, lambda: 1)
+
+    unloads = []
+    monkeypatch.setattr(streaming, 'unload_ollama_model', lambda: unloads.append('ollama'))
+    monkeypatch.setattr(streaming, 'unload_diffusion_model', lambda: unloads.append('comfyui'))
+
+    def generate_streaming(unload=True):
+        if unload:
+            streaming.unload_models()
+        return 2
+    monkeypatch.setattr(generate_video, 'generate_streaming', generate_streaming)
+
+    stories = [str(tmp_path / 'first'), str(tmp_path / 'second'), str(tmp_path / 'third')]
+    assert generate_video.run_batch(stories) == {}
+    assert unloads == ['ollama', 'comfyui']
+
+
+def test_fingerprint_follows_file_stats_without_reading_files(tmp_path, monkeypatch):
+    image = tmp_path / '0.png'
+    image.write_bytes(b'image')
+    pattern = str(tmp_path / '*.png')
+    key = generate_video.fingerprint(pattern, settings=Pipeline)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("fingerprint read a file")
+    monkeypatch.setattr('builtins.open', fail)
+    assert generate_video.fingerprint(pattern, settings=Pipeline) == key
+    os.utime(image, ns=(0, 0))
+    assert generate_video.fingerprint(pattern, settings=Pipeline) != key
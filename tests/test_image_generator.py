@@ -0,0 +1,46 @@
+import os
+from concurrent.futures import Future
+import settings
+from cache import Manifest
+from image_generator import ImageQueue
+
+
+def write_images(tmp_path, prompts):
+    """Record an earlier run that generated an image for each prompt."""
+    images = ImageQueue(prompts)
+    os.makedirs(images.images_directory, exist_ok=True)
+    for index in range(len(prompts)):
+        with open(images.image_path(index), 'wb') as f:
+            f.write(prompts[index].encode('utf-8'))
+        images.manifest.set(index, images.keys[index])
+    images.manifest.save()
+
+
+def test_fewer_prompts_reuse_existing_images(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'SOURCE_DIRECTORY', str(tmp_path))
+    write_images(tmp_path, ['a', 'b', 'c', 'd', 'e'])
+
+    images = ImageQueue(['b', None, 'f'])
+    assert images.pending == [1, 2]
+    with open(images.image_path(0), 'rb') as f:
+        assert f.read() == b'b'
+    assert sorted(os.listdir(images.images_directory)) == ['0.png']
+    assert Manifest('images').entries == {'0': images.keys[0]}
+
+
+def test_saved_images_are_logged_until_the_queue_is_saved(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'SOURCE_DIRECTORY', str(tmp_path))
+    images = ImageQueue(['a', 'b', 'c'])
+    manifest_path = tmp_path / '.cache' / 'images.json'
+    saved = manifest_path.read_text()
+
+    done = Future()
+    done.set_result(None)
+    for index in images.pending:
+        images.record(index, done)
+    assert manifest_path.read_text() == saved
+    assert Manifest('images').entries == {str(index): key for index, key in enumerate(images.keys)}
+
+    images.save()
+    assert not (tmp_path / '.cache' / 'images.log').exists()
+    assert Manifest('images').entries == {str(index): key for index, key in enumerate(images.keys)}
@@ -0,0 +1,114 @@
+import json
+import threading
+import pytest
+import prompt_generator
+import settings
+from benchmarks.stub_servers import LLMServer
+from image_generator import get_prompts
+from cache import ResponseCache
+
+
+def test_batched_scenes_are_written_one_per_line(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'SOURCE_DIRECTORY', str(tmp_path))
+    response = json.dumps({"1": "A woman stands.\n\nA man sits.", "2": "A dog\nruns.", "3": "A boat drifts."})
+    monkeypatch.setattr(prompt_generator, 'get_response', lambda text_prompt, schema=None: response)
+
+    scenes = prompt_generator.get_scene_batch([0, 1, 2], lambda indices: 'prompt')
+    path = str(tmp_path / 'scenes.txt')
+    with prompt_generator.SceneWriter(path, [None] * 3) as writer:
+        for index, scene in sorted(scenes.items()):
+            writer.put(index, scene)
+
+    expected = ["A woman stands.  A man sits.", "A dog runs.", "A boat drifts."]
+    assert get_prompts() == expected
+    assert prompt_generator.read_scenes(path) == expected
+
+
+@pytest.fixture
+def llm_server(tmp_path, monkeypatch):
+    server = LLMServer(first_token_latency=0, token_latency=0, tokens=20, think_tokens=40)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(settings.PromptGeneration, 'HOST', '127.0.0.1')
+    monkeypatch.setattr(settings.PromptGeneration, 'PORT', server.server_address[1])
+    monkeypatch.setattr(settings.PromptGeneration, 'STREAM', True)
+    monkeypatch.setattr(prompt_generator, '_response_cache', ResponseCache(str(tmp_path / 'responses.sqlite'), 1024 * 1024))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('use_ollama', [True, False])
+def test_reasoning_over_budget_twice_still_answers(llm_server, monkeypatch, use_ollama):
+    monkeypatch.setattr(settings.PromptGeneration, 'USE_OLLAMA', use_ollama)
+    monkeypatch.setattr(settings.PromptGeneration, 'THINK_TOKENS', 5)
+
+    # Ollama disables reasoning on the retry, while a low reasoning effort still runs over budget
+    response = prompt_generator.get_response('Describe the scene.')
+    assert response and '<think>' not in response
+    assert llm_server.requests == 2
+
+
+def test_answer_stops_after_complete_sentences(llm_server, monkeypatch):
+    monkeypatch.setattr(settings.PromptGeneration, 'ANSWER_SENTENCES', 1)
+    monkeypatch.setattr(llm_server, 'generate', lambda prompt, schema=None, reasoning=1.0:
+                        iter(['<think>', ' hmm', '</think>', 'A dog runs.', ' A cat', ' sleeps.', ' More.']))
+
+    assert prompt_generator.get_response('Describe the scene.') == 'A dog runs.'
+
+
+@pytest.mark.parametrize('window', [None, 1, 5])
+def test_editing_a_segment_only_changes_nearby_scene_keys(window):
+    template = '<BEFORE>\n<LINE>\n<AFTER>\n<SUMMARY>'
+    lines = [f'Segment {index}.' for index in range(20)]
+    edited = lines[:10] + ['An edited segment.'] + lines[11:]
+
+    keys = [prompt_generator.get_scene_key(index, template, lines, window) for index in range(20)]
+    edited_keys = [prompt_generator.get_scene_key(index, template, edited, window) for index in range(20)]
+    key_window = settings.PromptGeneration.KEY_WINDOW if window is None else min(window, settings.PromptGeneration.KEY_WINDOW)
+    changed = [index for index in range(20) if keys[index] != edited_keys[index]]
+    assert changed == list(range(10 - key_window, 11 + key_window))
+
+
+def test_think_and_answer_budgets_allow_the_same_number_of_tokens(llm_server, monkeypatch):
+    monkeypatch.setattr(settings.PromptGeneration, 'THINK_TOKENS', 3)
+    monkeypatch.setattr(settings.PromptGeneration, 'ANSWER_TOKENS', 3)
+    requests = []
+    def generate(prompt, schema=None, reasoning=1.0):
+        requests.append(reasoning)
+        return iter(['<think>', ' hmm', '</think>', 'A', ' dog', ' runs', ' fast'])
+    monkeypatch.setattr(llm_server, 'generate', generate)
+
+    # Three tokens of reasoning, counting its tags, are within the budget, and the answer keeps its first three tokens
+    assert prompt_generator.get_response('Describe the scene.') == 'A dog runs'
+    assert requests == [1.0]
+
+
+def test_cut_off_batches_are_not_cached(llm_server, monkeypatch):
+    monkeypatch.setattr(settings.PromptGeneration, 'ANSWER_TOKENS', 2)
+    schema = prompt_generator.get_scene_schema(2)
+
+    for attempt in range(2):
+        with pytest.raises(ValueError):
+            prompt_generator.parse_scene_batch(prompt_generator.get_response('Describe the scenes.', schema), 2)
+    assert llm_server.requests == 2
+
+    # A complete response is cached as usual
+    monkeypatch.setattr(settings.PromptGeneration, 'ANSWER_TOKENS', None)
+    for attempt in range(2):
+        assert len(prompt_generator.parse_scene_batch(prompt_generator.get_response('Describe the scenes.', schema), 2)) == 2
+    assert llm_server.requests == 3
+
+
+def test_each_story_reports_its_own_response_stats(tmp_path, llm_server, monkeypatch, capsys):
+    monkeypatch.setattr(settings.PromptGeneration, 'CONTEXT_WINDOW', None)
+    monkeypatch.setattr(prompt_generator, 'get_image_segments', lambda: ['A dog runs.', 'A cat sleeps.'])
+    for story in ['first', 'second']:
+        monkeypatch.setattr(settings, 'SOURCE_DIRECTORY', str(tmp_path / story))
+        assert prompt_generator.generate_scenes() == 2
+
+    # The second story reuses both responses of the first from the cache
+    output = capsys.readouterr().out.splitlines()
+    assert [line for line in output if line.startswith('Response cache')] == [
+        'Response cache: 0 hits, 2 misses', 'Response cache: 2 hits, 0 misses']
+    streamed = [line for line in output if line.startswith('Streamed responses')]
+    assert streamed[0].startswith('Streamed responses: 2 streamed') and streamed[1] == 'Streamed responses: no streamed responses'
@@ -0,0 +1,46 @@
+import random
+import pytest
+from script_annotator import divide_into_segments
+
+
+def baseline_divide_into_segments(durations, target):
+    """The unbounded O(n^2) dynamic program divide_into_segments replaced."""
+    n = len(durations)
+    if n == 0:
+        return []
+    prefix = [0] * (n + 1)
+    for i in range(n):
+        prefix[i + 1] = prefix[i] + durations[i]
+    dp = [float('inf')] * (n + 1)
+    dp[0] = 0
+    prev = [0] * (n + 1)
+    for i in range(1, n + 1):
+        for j in range(i):
+            cost = abs(prefix[i] - prefix[j] - target)
+            if dp[j] + cost < dp[i]:
+                dp[i] = dp[j] + cost
+                prev[i] = j
+    start_indices = []
+    i = n
+    while i > 0:
+        start_indices.append(prev[i])
+        i = prev[i]
+    start_indices.reverse()
+    return start_indices
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_baseline_on_random_durations(seed):
+    rng = random.Random(seed)
+    durations = [rng.uniform(0.2, 12) for _ in range(rng.randint(0, 120))]
+    target = rng.choice([0, 0.5, 3, 10, 45, 500])
+    assert divide_into_segments(durations, target) == baseline_divide_into_segments(durations, target)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_baseline_with_ties(seed):
+    # Whole-second durations often give several equally good segmentations, which must be broken the same way
+    rng = random.Random(seed)
+    durations = [float(rng.randint(1, 6)) for _ in range(rng.randint(1, 120))]
+    target = float(rng.randint(0, 20))
+    assert divide_into_segments(durations, target) == baseline_divide_into_segments(durations, target)
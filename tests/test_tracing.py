@@ -0,0 +1,21 @@
+import time
+import numpy as np
+import settings
+import tracing
+from settings import Pipeline
+
+
+def test_steps_report_their_own_peak_rss(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'SOURCE_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(Pipeline, 'TRACE', True)
+    tracing.start()
+    with tracing.step('large'):
+        buffer = np.ones(200 * 1024 * 1024, dtype=np.uint8)
+        time.sleep(3 * tracing.RSS_INTERVAL) # Let the sampler see the buffer before it's freed
+        del buffer
+    with tracing.step('small'):
+        pass
+
+    summary = tracing.summarize()
+    assert summary['large']['peak_rss'] - summary['small']['peak_rss'] > 150
+    assert abs(summary['small']['rss_delta']) < 50
@@ -0,0 +1,218 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+import settings
+from settings import Pipeline
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+
+_lock = threading.Lock()
+
+
+def get_trace_path() -> str:
+    return os.path.join(settings.SOURCE_DIRECTORY, '.cache', 'trace.jsonl')
+
+
+def start():
+    """Start a new trace, discarding the previous one."""
+    if not Pipeline.TRACE: return
+    os.makedirs(os.path.dirname(get_trace_path()), exist_ok=True)
+    open(get_trace_path(), 'w').close()
+
+
+def record(name: str, start_time: float, duration: float, **attributes):
+    """
+    Append a span to the trace, started at start_time (from time.time()) and lasting duration seconds.
+    Spans are written with a single append, so worker processes can add to the same trace.
+    """
+    if not Pipeline.TRACE: return
+    entry = {'name': name, 'start': start_time, 'duration': duration, 'pid': os.getpid(),
+             'thread': threading.current_thread().name, **attributes}
+    line = json.dumps(entry) + '\n'
+    with _lock:
+        with open(get_trace_path(), 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record the time spent in the block as a span, adding any attributes set on the yielded dict."""
+    if not Pipeline.TRACE:
+        yield attributes
+        return
+    start_time, counter = time.time(), time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        record(name, start_time, time.perf_counter() - counter, **attributes)
+
+
+RSS_INTERVAL = 0.1 # Seconds between samples of the RSS during a step
+
+
+def get_peak_rss() -> float:
+    """Return the peak RSS in MB of this process or any of its finished child processes over their lifetime."""
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024 # ru_maxrss is in bytes on macOS and KB elsewhere
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return max(own.ru_maxrss, children.ru_maxrss) / scale
+
+
+def get_rss() -> float:
+    """Return the current RSS in MB of this process and all of its descendants, or None without /proc."""
+    if not os.path.isdir('/proc/self'):
+        return None
+    children = defaultdict(list)
+    pages = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r', encoding='utf-8') as f:
+                fields = f.read().rpartition(')')[2].split() # The command name may hold spaces
+        except OSError: # The process exited
+            continue
+        children[int(fields[1])].append(int(entry))
+        pages[int(entry)] = int(fields[21])
+    total, stack = 0, [os.getpid()]
+    while stack:
+        pid = stack.pop()
+        total += pages.get(pid, 0)
+        stack.extend(children[pid])
+    return total * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class RSSSampler:
+    """Samples the RSS of this process and its descendants in a background thread, keeping the peak."""
+
+    def __init__(self):
+        self.start_rss = self.peak = get_rss()
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.start_rss is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, get_rss())
+
+    def stop(self) -> dict:
+        """
+        Stop sampling, returning the peak RSS during the sampling and the change in RSS since it started,
+        or the process's peak RSS so far where the RSS can't be sampled.
+        """
+        if self.thread is None:
+            return {'process_peak_rss': get_peak_rss()}
+        self.stopped.set()
+        self.thread.join()
+        end_rss = get_rss()
+        return {'peak_rss': max(self.peak, end_rss), 'rss_delta': end_rss - self.start_rss}
+
+
+@contextmanager
+def step(name: str):
+    """
+    Record a pipeline step as a span with the peak RSS during it and the change in RSS over it, profiling
+    it with cProfile if it's listed in Pipeline.PROFILE and tracing its allocations if it's listed in
+    Pipeline.TRACE_MEMORY.
+    """
+    profiler = cProfile.Profile() if name in Pipeline.PROFILE else None
+    trace_memory = name in Pipeline.TRACE_MEMORY and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        with span(name, kind='step') as attributes:
+            sampler = RSSSampler() if Pipeline.TRACE else None
+            try:
+                yield
+            finally:
+                if sampler:
+                    attributes.update(sampler.stop())
+    finally:
+        if profiler:
+            profiler.disable()
+            print_profile(name, profiler)
+        if trace_memory:
+            print_allocations(name)
+
+
+def print_profile(name: str, profiler: cProfile.Profile):
+    path = os.path.join(settings.SOURCE_DIRECTORY, '.cache', f"profile-{name.replace(' ', '-')}.prof")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profiler.dump_stats(path)
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(15)
+    print(f"\nProfile of {name} (saved to {path}):{output.getvalue()}")
+
+
+def print_allocations(name: str):
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"\nAllocations during {name}, peak {peak / 1024 / 1024:.1f} MB traced, largest remaining:")
+    for statistic in snapshot.statistics('lineno')[:10]:
+        print(f"  {statistic}")
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Return the nearest-rank percentile of sorted values."""
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summarize() -> Dict[str, dict]:
+    """
+    Read the trace and group the spans into the steps whose time they fall within, returning for each
+    step its duration, memory and the count, throughput and latency percentiles of each span name.
+    """
+    with open(get_trace_path(), 'r', encoding='utf-8') as f:
+        spans = [json.loads(line) for line in f if line.strip()]
+    steps = sorted((s for s in spans if s.get('kind') == 'step'), key=lambda s: s['start'])
+    summary = {}
+    for step_span in steps:
+        end = step_span['start'] + step_span['duration']
+        durations = defaultdict(list)
+        for s in spans:
+            if s.get('kind') != 'step' and step_span['start'] <= s['start'] <= end:
+                durations[s['name']].append(s['duration'])
+        summary[step_span['name']] = {
+            'duration': step_span['duration'],
+            'peak_rss': step_span.get('peak_rss'),
+            'rss_delta': step_span.get('rss_delta'),
+            'process_peak_rss': step_span.get('process_peak_rss'),
+            'spans': {name: sorted(values) for name, values in durations.items()},
+        }
+    return summary
+
+
+def print_summary():
+    if not Pipeline.TRACE or not os.path.isfile(get_trace_path()): return
+    print(f"\nTrace written to {get_trace_path()}")
+    print(f"{'step / span':<28}{'count':>7}{'per s':>9}{'total s':>10}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for name, step_summary in summarize().items():
+        memory = ''
+        if step_summary['peak_rss'] is not None:
+            memory = f", peak RSS {step_summary['peak_rss']:.0f} MB, RSS change {step_summary['rss_delta']:+.0f} MB"
+        elif step_summary['process_peak_rss'] is not None:
+            memory = f", process peak RSS so far {step_summary['process_peak_rss']:.0f} MB"
+        print(f"{name} ({step_summary['duration']:.2f}s{memory})")
+        for span_name, values in step_summary['spans'].items():
+            rate = len(values) / step_summary['duration'] if step_summary['duration'] else 0
+            print(f"  {span_name:<26}{len(values):>7}{rate:>9.2f}{sum(values):>10.2f}"
+                  f"{percentile(values, 0.5):>9.3f}{percentile(values, 0.9):>9.3f}{percentile(values, 0.99):>9.3f}{values[-1]:>9.3f}")
@@ -1,8 +1,71 @@
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import soundfile as sf
-from kokoro import KPipeline
-from utility import parse_lines, print_progress_bar
-from settings import TTSGeneration, SOURCE_DIRECTORY
+import tracing
+from audio_store import PackedAudio
+from cache import Manifest, digest, remap_files
+from utility import get_audio_durations, parse_lines, print_progress_bar
+import settings
+from settings import TTSGeneration
+
+
+_pipeline = None
+_executor = None
+
+
+def load_pipeline(threads: int = None):
+    """Load the Kokoro pipeline for this process unless it's loaded, optionally limiting the CPU threads it uses."""
+    global _pipeline
+    if _pipeline is not None: return
+    import torch
+    from kokoro import KPipeline
+    if threads:
+        torch.set_num_threads(threads)
+    _pipeline = KPipeline(lang_code='a') # lang_code must match voice
+
+
+def synthesize(line: str) -> np.ndarray:
+    """Generate the audio samples for a line."""
+    with tracing.span('tts line', characters=len(line)):
+        results = _pipeline(line, voice=TTSGeneration.VOICE, speed=TTSGeneration.SPEED)
+        audio = [np.asarray(audio, dtype=np.float32) for _, _, audio in results if audio is not None]
+        return np.concatenate(audio) if audio else np.zeros(0, dtype=np.float32)
+
+
+def synthesize_for(directory: str, line: str) -> np.ndarray:
+    """Generate the audio samples for a line of the story in directory, in a worker that may have been started for another story."""
+    settings.SOURCE_DIRECTORY = directory
+    return synthesize(line)
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Return the pool of TTS worker processes, each loading the model once and using its share of the
+    cores. The pool is kept for the rest of the process, so a batch of stories loads the model once.
+    """
+    global _executor
+    if _executor is None:
+        threads = max(1, (os.cpu_count() or 1) // TTSGeneration.WORKERS)
+        _executor = ProcessPoolExecutor(max_workers=TTSGeneration.WORKERS, initializer=load_pipeline, initargs=(threads,))
+    return _executor
+
+
+def write_audio(path: str, audio: np.ndarray):
+    """Write audio to a WAV file atomically, so a partial file is never left behind."""
+    temp_path = path + '.tmp'
+    sf.write(temp_path, audio, TTSGeneration.SAMPLE_RATE, format='WAV')
+    os.replace(temp_path, path)
+
+
+def is_valid_audio(path: str) -> bool:
+    """Return True if path is a readable audio file with at least one sample."""
+    if not os.path.isfile(path):
+        return False
+    try:
+        return sf.info(path).frames > 0
+    except RuntimeError:
+        return False
 
 
 def generate_tts():
@@ -11,23 +74,65 @@ def generate_tts():
     if not TTSGeneration.VOICE: return
 
     # Make the audio directory if necessary
-    audio_dir = os.path.join(SOURCE_DIRECTORY, 'audio')
+    audio_dir = os.path.join(settings.SOURCE_DIRECTORY, 'audio')
     if not os.path.exists(audio_dir):
         os.makedirs(audio_dir)
 
     # Get an ordered list of the lines
-    lines = [item[2] for item in parse_lines('captions')]
-
-    # Generate and save audio files in a loop.
-    pipeline = KPipeline(lang_code='a') # lang_code must match voice
-    generator = pipeline(lines, voice=TTSGeneration.VOICE, speed=TTSGeneration.SPEED)
-    count = len(lines)
-    for i, (_, _, audio) in enumerate(generator):
-        print_progress_bar(i, count, "audio generated")
-        clip_path = os.path.join(audio_dir, f'{i}.wav')
-        sf.write(clip_path, audio, TTSGeneration.SAMPLE_RATE) # Save each audio file
+    lines = [item.text for item in parse_lines('captions')]
+
+    # Reuse valid audio for lines whose text and voice settings haven't changed
+    keys = [digest(line, TTSGeneration.VOICE, TTSGeneration.SPEED, TTSGeneration.SAMPLE_RATE) for line in lines]
+    clip_path = lambda index: os.path.join(audio_dir, f'{index}.wav')
+    manifest = Manifest('tts')
+    if TTSGeneration.PACKED:
+        store = PackedAudio(audio_dir)
+        sources = manifest.plan(keys, lambda index: index in store)
+        store.remap(sources)
+    else:
+        sources = manifest.plan(keys, lambda index: is_valid_audio(clip_path(index)))
+        remap_files(audio_dir, 'wav', sources)
+    manifest.reset(keys, sources)
+    pending = [index for index, source in enumerate(sources) if source is None]
+    if not pending:
+        get_audio_durations(len(lines)) # Index the durations of the reused files
+        return 0
+
+    # Generate and save audio, logging each line as soon as it's written so an interrupted run resumes
+    def save(index, audio):
+        if TTSGeneration.PACKED:
+            store.append(index, audio)
+        else:
+            write_audio(clip_path(index), audio)
+        manifest.record(index, keys[index])
+
+    count = len(pending)
+    print_progress_bar(0, count, "audio generated")
+    try:
+        if TTSGeneration.WORKERS <= 1:
+            load_pipeline()
+            for i, index in enumerate(pending):
+                save(index, synthesize(lines[index]))
+                print_progress_bar(i + 1, count, "audio generated")
+        else:
+            # Shard the lines across the worker processes
+            executor = get_executor()
+            futures = {executor.submit(synthesize_for, settings.SOURCE_DIRECTORY, lines[index]): index for index in pending}
+            try:
+                for i, future in enumerate(as_completed(futures)):
+                    save(futures[future], future.result())
+                    print_progress_bar(i + 1, count, "audio generated")
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        manifest.save()
+        if TTSGeneration.PACKED:
+            store.close()
     print_progress_bar(count, count, "audio generated\n")
+    get_audio_durations(len(lines)) # Index the durations of the new files from their headers
+    return count
 
 
 if __name__ == "__main__":
-    generate_tts()
\ No newline at end of file
+    generate_tts()
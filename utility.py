@@ -1,45 +1,93 @@
+import json
 import os
 import re
 import sys
-from typing import List, Tuple
-from moviepy import AudioFileClip
-from settings import ScriptAnnotation, SOURCE_DIRECTORY
-
-
-def parse_lines(file: str = 'script') -> List[Tuple[float, str, str]]:
-
-    # Read the script file
-    path = os.path.join(SOURCE_DIRECTORY, f'{file}.txt')
-    with open(path, 'r', encoding='utf-8') as file:
-        script_lines = file.readlines()
-
-    script_lines = [line.strip() for line in script_lines if line.strip()]
-
-    result: List[Tuple[float, str, str]] = []
-
-    for line in script_lines:
-        # Initialize variables
-        image_name = None
-        duration = None
-
-        # Check for image name and duration at the start of the line
-        matches = re.findall(r'\[([^\]]+)\]', line)
-        for match in matches:
-            try:
-                # If it can be parsed as a float, it's a duration
-                duration = float(match)
-            except ValueError:
-                # Otherwise, it's an image name
-                image_name = match
-            line = line.replace(f'[{match}]', '', 1)  # Remove the tag from the line
-        line = line.strip()
-
-        # If no duration was found, calculate it based on words count
-        if not duration:
-            duration = approximate_duration(line)
+from typing import List, NamedTuple, Optional, Tuple, Union
+import numpy as np
+import soundfile as sf
+from audio_store import PackedAudio
+from cache import digest
+import settings
+from settings import ScriptAnnotation, TTSGeneration
+
+
+class ScriptLine(NamedTuple):
+    duration: float # Duration from a [seconds] tag, or approximated from the word count
+    image: Optional[str] # Image name from an [image] tag, if any
+    text: str
+
+
+def parse_line(line: str) -> ScriptLine:
+    # Initialize variables
+    image_name = None
+    duration = None
+
+    # Check for image name and duration at the start of the line
+    matches = re.findall(r'\[([^\]]+)\]', line)
+    for match in matches:
+        try:
+            # If it can be parsed as a float, it's a duration
+            duration = float(match)
+        except ValueError:
+            # Otherwise, it's an image name
+            image_name = match
+        line = line.replace(f'[{match}]', '', 1)  # Remove the tag from the line
+    line = line.strip()
+
+    # If no duration was found, calculate it based on words count
+    if not duration:
+        duration = approximate_duration(line)
+
+    return ScriptLine(duration, image_name, line)
+
+
+def get_script_cache(file: str) -> str:
+    return os.path.join(settings.SOURCE_DIRECTORY, '.cache', f'{file}.json')
+
+
+def save_script_cache(file: str, key: str, lines: List[ScriptLine]):
+    path = get_script_cache(file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'key': key, 'lines': lines}, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def parse_lines(file: str = 'script') -> List[ScriptLine]:
+    """
+    Return the lines of a script file with their tags parsed.
+
+    The parsed lines are stored in .cache/{file}.json with a hash of the file's contents, so the
+    text is only parsed again after it changes.
+    """
+    path = os.path.join(settings.SOURCE_DIRECTORY, f'{file}.txt')
+    with open(path, 'rb') as f:
+        content = f.read()
+    key = digest(content, ScriptAnnotation.WORDS_PER_MINUTE)
+
+    # Load the parsed lines if they're up to date
+    try:
+        with open(get_script_cache(file), 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            return [ScriptLine(*line) for line in cached['lines']]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    script_lines = content.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    result = [parse_line(line.strip()) for line in script_lines if line.strip()]
+    save_script_cache(file, key, result)
+    return result
 
-        result.append((duration, image_name, line))
 
+def write_script(file: str, script_lines: List[str]) -> List[ScriptLine]:
+    """Write lines to a script file, each followed by a blank line, along with their parsed form."""
+    content = ''.join(line + '\n\n' for line in script_lines).encode('utf-8')
+    with open(os.path.join(settings.SOURCE_DIRECTORY, f'{file}.txt'), 'wb') as f:
+        f.write(content)
+    result = [parse_line(line.strip()) for line in script_lines if line.strip()]
+    save_script_cache(file, digest(content, ScriptAnnotation.WORDS_PER_MINUTE), result)
     return result
 
 
@@ -56,13 +104,58 @@ def print_progress_bar(index, total, action):
     sys.stdout.flush()
 
 
-def get_audio_clips(count: int):
-    audio_clips = [None] * count
-    audio_dir = os.path.join(SOURCE_DIRECTORY, 'audio')
-    if os.path.isdir(audio_dir):
-        for index in range(count):
-            audio_file = os.path.join(audio_dir, f'{index}.wav')
-            if not os.path.isfile(audio_file): continue
-            audio_clip = AudioFileClip(audio_file)
-            audio_clips[index] = audio_clip
-    return audio_clips
\ No newline at end of file
+def get_audio_files(count: int) -> List[Optional[str]]:
+    """Return the path of each line's audio file, or None for lines without one."""
+    audio_dir = os.path.join(settings.SOURCE_DIRECTORY, 'audio')
+    audio_files = [os.path.join(audio_dir, f'{index}.wav') for index in range(count)]
+    return [audio_file if os.path.isfile(audio_file) else None for audio_file in audio_files]
+
+
+def get_line_audio(count: int) -> List[Union[str, Tuple[np.ndarray, int], None]]:
+    """
+    Return each line's audio, as the path of its audio file or, with TTSGeneration.PACKED, as its
+    memory-mapped samples and sample rate. Lines without audio are None.
+    """
+    if not TTSGeneration.PACKED:
+        return get_audio_files(count)
+    store = PackedAudio()
+    return [store.get(index) if index in store else None for index in range(count)]
+
+
+def get_audio_durations(count: int) -> List[Optional[float]]:
+    """
+    Return the duration of each line's audio, or None for lines without one.
+
+    With TTSGeneration.PACKED, durations are read from the packed audio index. Otherwise they are read
+    from the WAV headers and recorded in audio/durations.json with each file's size and modification
+    time, so later calls only read the headers of files that changed.
+    """
+    if TTSGeneration.PACKED:
+        store = PackedAudio()
+        return [store.duration(index) if index in store else None for index in range(count)]
+
+    index_path = os.path.join(settings.SOURCE_DIRECTORY, 'audio', 'durations.json')
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+
+    durations = []
+    updated = {}
+    for i, audio_file in enumerate(get_audio_files(count)):
+        if audio_file is None:
+            durations.append(None)
+            continue
+        stat = os.stat(audio_file)
+        entry = index.get(str(i))
+        if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'duration': sf.info(audio_file).duration}
+        updated[str(i)] = entry
+        durations.append(entry['duration'])
+
+    if updated != index:
+        temp_path = index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(updated, f)
+        os.replace(temp_path, index_path)
+    return durations